@@ -0,0 +1,122 @@
+# Micro-benchmark for the register decoder: decoded registers/sec of the old
+# if-chain _decode against the table driven decoder in nibe_registers.py.
+#
+# Run from the repository root: python benchmarks/bench_decode.py
+import logging
+import os
+import sys
+import time
+from struct import unpack, pack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nibe_registers import build_register_table, raw_value
+
+logger = logging.getLogger('NIBE')
+logger.setLevel(logging.WARNING)
+
+# A typical frame worth of (register, raw bytes), taken from register.txt
+sample_frame = [
+    (0, b"\x59"), (1, b"\x00\xa6"), (4, b"\x00\x00"), (5, b"\x00\xde"), (6, b"\x00\xfc"),
+    (7, b"\x00\xed"), (8, b"\xff\xf6"), (9, b"\x00\x00"), (10, b"\x00\x00"), (11, b"\x01\x05"),
+    (12, b"\x01\xf7"), (13, b"\x01\xe5"), (14, b"\x00\x8c"), (15, b"\x00\x8c"), (16, b"\x00\xe4"),
+    (17, b"\x01\x54"), (18, b"\x00\xcb"), (19, b"\x00\x81"), (20, b"\x00\x63"), (21, b"\x00\x9e"),
+    (22, b"\x00\x00"), (23, b"\x01\x0e"), (24, b"\xdf\x06"), (25, b"\x03\x84"), (31, b"\x01"),
+    (32, b"\x00"), (33, b"\x03\x00"), (34, b"\x05"), (35, b"\x46"), (36, b"\x03"),
+    (38, b"\x7e"), (40, b"\x02"), (43, b"\x11"), (44, b"\x46"), (45, b"\x0e"),
+    (46, b"\x6e"), (47, b"\x05"), (48, b"\x28"), (49, b"\x2c"), (50, b"\x32"),
+    (100, b"\x0d"), (101, b"\x0a"), (102, b"\x1d"), (103, b"\x11"), (104, b"\x1e"), (105, b"\x2b"),
+]
+
+
+# The if-chain decoder as it was before the descriptor table (operation mode
+# registers left out, they never returned a value)
+def legacy_decode(reg, raw):
+    if len(raw) == 2:
+        value = unpack('>H', raw)[0]
+    else:
+        value = unpack('B', raw)[0]
+
+    if reg == 32:
+        logger.debug(f"Register 32 (additional heating allowed) value: {value}")
+        return str(value)
+    if reg == 31:
+        logger.debug(f"Register 31 (heating status) value: {value}")
+        if value == 1:
+            return "auto"
+        elif value == 3:
+            return "lämmitys"
+        elif value == 5:
+            return "lämminvesi"
+        elif value == 6:
+            return "lisäys (sähkö)"
+        return None
+    if reg in [1, 5, 6, 7, 12, 23, 11, 13, 14, 15, 16, 17, 18, 21]:
+        logger.debug(f"Register {reg} (temperature/flow) value: {value}")
+        return float(unpack('h', pack('H', value))[0] / 10)
+    if reg in [0, 33, 34, 35, 36, 38, 44, 45, 46, 48, 100, 101, 102, 103, 104, 105]:
+        logger.debug(f"Register {reg} (general integer) value: {value}")
+        return int(value)
+    if reg in [4, 8]:
+        logger.debug(f"Register {reg} (signed value) value: {value}")
+        return int(unpack('h', pack('H', value))[0] / 10)
+    if reg == 25:
+        logger.debug(f"Register 25 (compressor starts) value: {value}")
+        return int(value / 10)
+    if reg in [9, 10, 19, 20, 22, 24]:
+        logger.debug(f"Register {reg} (frequency/pressure) value: {value}")
+        return float(value / 10)
+    if reg in [40, 47]:
+        logger.debug(f"Register {reg} (hysteresis/BW reg) value: {value}")
+        return float(value / 2)
+    if reg in [43, 49, 50]:
+        logger.debug(f"Register {reg} (temperature) value: {value}")
+        return float(value)
+    logger.warning(f"Register {reg} is not handled")
+    return None
+
+
+def bench_legacy(frames):
+    for _ in range(frames):
+        for reg, raw in sample_frame:
+            legacy_decode(reg, raw)
+
+
+def bench_table(frames):
+    # Same work as the parser loop in nibe.run(): the raw value is already an
+    # int when it reaches the decoder
+    table = build_register_table()
+    values = [(reg, raw_value(raw)) for reg, raw in sample_frame]
+    for _ in range(frames):
+        for reg, value in values:
+            entry = table[reg]
+            if entry is not None:
+                entry.decode(value)
+
+
+def measure(func, frames):
+    start = time.perf_counter()
+    func(frames)
+    elapsed = time.perf_counter() - start
+    return frames * len(sample_frame) / elapsed
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    # Both decoders have to agree before their speed means anything
+    table = build_register_table()
+    for reg, raw in sample_frame:
+        expected = legacy_decode(reg, raw)
+        actual = table[reg].decode(raw_value(raw))
+        assert expected == actual and type(expected) is type(actual), (reg, expected, actual)
+
+    before = measure(bench_legacy, frames)
+    after = measure(bench_table, frames)
+    print(f"if-chain _decode : {before:12,.0f} registers/s")
+    print(f"descriptor table : {after:12,.0f} registers/s")
+    print(f"speedup          : {after / before:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# Benchmark suite of the hot path: framing, checksum, register decoding,
+# operation mode lookup and the MQTT publish path, on synthetic frames (see
+# synthetic_frames.py). Each stage reports its throughput and the latency of
+# a single call (median and 99th percentile).
+#
+# Decoding and publishing run the production code: a HeatPump built by
+# nibe.setup() decodes the frames (HeatPump.decode_frame, with the history,
+# derived values and snapshot) and publishes the values
+# (HeatPump.publish_values, change filter, outbox, paho) to a local stub
+# broker over TCP (stub_broker.py). Needs paho-mqtt and pyserial like the
+# bridge itself.
+#
+# Results can be saved and later runs compared against them, a stage whose
+# throughput dropped by more than the threshold fails the comparison (exit
+# code 1). Baselines depend on the machine, save one on the machine the
+# comparison runs on.
+#
+# Run from the repository root:
+#   python benchmarks/bench_suite.py --save benchmarks/baseline.json
+#   python benchmarks/bench_suite.py --compare benchmarks/baseline.json
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_broker import StubBroker
+from synthetic_frames import generate_frames, generate_stream
+import nibe
+from nibe_framing import FrameParser, checksum_ok
+from nibe_modes import OperationModeDecoder
+
+logging.getLogger('NIBE').setLevel(logging.CRITICAL)
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def start_bridge(broker, timeout=5):
+    # The bridge as configured in nibe.py, connected to the stub broker,
+    # without state files, outputs besides MQTT or background threads
+    nibe.mqtt_host = broker.host
+    nibe.mqtt_port = broker.port
+    nibe.discovery_state_file = None
+    nibe.sqlite_file = None
+    nibe.influx_file = None
+    nibe.json_stream = None
+    nibe.setup()
+    nibe.connect_mqtt()
+    deadline = time.monotonic() + timeout
+    while not nibe.outbox.is_connected:
+        if time.monotonic() > deadline:
+            sys.exit(f"No connection to the stub broker on {broker.host}:{broker.port}")
+        time.sleep(0.01)
+
+
+def stop_bridge():
+    nibe.mqtt_client.loop_stop()
+    nibe.mqtt_client.disconnect()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def measure(name, unit, setup, run, ops, repeat, min_time=0.2):
+    # Best throughput of `repeat` runs, each one calls run(state, None) (ops
+    # operations) for at least min_time seconds. Latency of single
+    # run(state, i) calls afterwards.
+    best = 0.0
+    latencies = []
+    for _ in range(repeat):
+        state = setup()
+        rounds = 0
+        start = time.perf_counter()
+        while True:
+            run(state, None)
+            rounds += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, rounds * ops / elapsed)
+    state = setup()
+    for i in range(min(ops, 5000)):
+        start = time.perf_counter_ns()
+        run(state, i)
+        latencies.append(time.perf_counter_ns() - start)
+    return name, {
+        "unit": unit,
+        "ops_per_s": round(best, 1),
+        "p50_us": round(percentile(latencies, 0.5) / 1000, 3),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 3),
+    }
+
+
+def run_suite(frame_count, repeat):
+    frames = generate_frames(frame_count)
+    chunks = generate_stream(frames)
+    valid = [frame for frame, ok in frames if ok]
+    decoder = OperationModeDecoder.from_file()
+    results = {}
+
+    # Framing: the whole line traffic through the parser, one feed() per read
+    def framing_setup():
+        return FrameParser(lambda data: None, lambda frame: None)
+
+    def framing_run(parser, i):
+        if i is None:
+            for chunk in chunks:
+                parser.feed(chunk)
+        else:
+            parser.feed(chunks[i % len(chunks)])
+
+    name, result = measure("framing", "reads", framing_setup, framing_run, len(chunks), repeat)
+    results[name] = result
+
+    # Checksum of the valid and the corrupted frames
+    all_frames = [frame for frame, _ in frames]
+
+    def crc_run(state, i):
+        if i is None:
+            for frame in all_frames:
+                checksum_ok(frame)
+        else:
+            checksum_ok(all_frames[i % len(all_frames)])
+
+    name, result = measure("crc", "frames", lambda: None, crc_run, len(all_frames), repeat)
+    results[name] = result
+
+    # Decoding: HeatPump.decode_frame of a fresh heat pump per run
+    heat_pump_config = nibe.heat_pumps_config[0]
+
+    def decode_run(heat_pump, i):
+        if i is None:
+            for frame in valid:
+                heat_pump.decode_frame(frame)
+        else:
+            heat_pump.decode_frame(valid[i % len(valid)])
+
+    name, result = measure("decode", "frames", lambda: nibe.HeatPump(heat_pump_config), decode_run, len(valid), repeat)
+    results[name] = result
+
+    # Operation mode lookup: known combinations, bits rules and unknown ones
+    keys = list(decoder.modes)
+    keys += [(0x2000 | 0x0100 * i, 0xA22A, 0x0100 + i) for i in range(len(keys) // 4 + 1)]
+    keys += [(0x0001, 0x0002, i) for i in range(len(keys) // 4 + 1)]
+    lookups = keys * (frame_count // len(keys) + 1)
+
+    def mode_run(state, i):
+        if i is None:
+            for key in lookups:
+                decoder.lookup(*key)
+        else:
+            decoder.lookup(*lookups[i % len(lookups)])
+
+    name, result = measure("mode_lookup", "lookups", lambda: None, mode_run, len(lookups), repeat)
+    results[name] = result
+
+    # Publish path: HeatPump.publish_values of the decoded values of every
+    # valid frame, through the change filter, the outbox and paho to the
+    # stub broker
+    heat_pump = nibe.heat_pumps[0]
+    decoded = [heat_pump.decode_frame(frame) for frame in valid]
+
+    def publish_setup():
+        heat_pump.change_filter.forget()
+        return heat_pump
+
+    def publish_run(heat_pump, i):
+        if i is None:
+            for values in decoded:
+                heat_pump.publish_values(values)
+        else:
+            heat_pump.publish_values(decoded[i % len(decoded)])
+
+    name, result = measure("publish", "frames", publish_setup, publish_run, len(decoded), repeat)
+    results[name] = result
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Names of the stages that got slower than the baseline by more than threshold
+    failed = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        change = result["ops_per_s"] / before["ops_per_s"] - 1
+        status = "FAIL" if change < -threshold else "ok"
+        if status == "FAIL":
+            failed.append(name)
+        print(f"{name:12} {before['ops_per_s']:14,.0f} -> {result['ops_per_s']:14,.0f} {result['unit']}/s {change:+7.1%}  {status}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the bridge hot path")
+    parser.add_argument("-n", "--frames", type=int, default=5000, help="synthetic frames per run (default 5000)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per stage, the best one counts (default 5)")
+    parser.add_argument("--save", nargs="?", const=default_baseline, help="save the results as baseline")
+    parser.add_argument("--compare", nargs="?", const=default_baseline, help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed throughput drop (default 0.15)")
+    args = parser.parse_args()
+
+    broker = StubBroker()
+    start_bridge(broker)
+    try:
+        results = run_suite(args.frames, args.repeat)
+    finally:
+        stop_bridge()
+        broker.close()
+    for name, result in results.items():
+        print(f"{name:12} {result['ops_per_s']:14,.0f} {result['unit']}/s   "
+              f"p50 {result['p50_us']:8.2f} us   p99 {result['p99_us']:8.2f} us")
+    print(f"Stub broker received {broker.messages:,} messages ({broker.bytes:,} bytes)")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "frames": args.frames,
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} (threshold {args.threshold:.0%}):")
+        failed = compare(results, baseline, args.threshold)
+        if failed:
+            print(f"Slower than the baseline: {', '.join(failed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Local MQTT broker stub for the benchmarks.
+#
+# Listens on 127.0.0.1 (a free port), accepts MQTT 3.1.1 and 5 clients,
+# answers CONNECT, QoS 1 PUBLISH and PINGREQ and counts the PUBLISH packets
+# and their bytes. Nothing is routed or stored, but the client side does the
+# real work: paho serializes every message and writes it to a TCP socket.
+import socket
+import threading
+
+CONNECT = 0x10
+PUBLISH = 0x30
+PINGREQ = 0xC0
+DISCONNECT = 0xE0
+
+
+class StubBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._accept, name="stub-broker", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buf = bytearray()
+        protocol = 4
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                while True:
+                    packet = _split_packet(buf)
+                    if packet is None:
+                        break
+                    kind, flags, body, size = packet
+                    del buf[:size]
+                    if kind == CONNECT:
+                        # Protocol name (length prefixed), then the level
+                        protocol = body[2 + int.from_bytes(body[:2], "big")]
+                        conn.sendall(b"\x20\x03\x00\x00\x00" if protocol == 5 else b"\x20\x02\x00\x00")
+                    elif kind == PUBLISH:
+                        with self.lock:
+                            self.messages += 1
+                            self.bytes += size
+                        if flags & 0x06:
+                            # QoS 1: PUBACK with the packet id after the topic
+                            offset = 2 + int.from_bytes(body[:2], "big")
+                            packet_id = bytes(body[offset:offset + 2])
+                            conn.sendall(b"\x40\x02" + packet_id)
+                    elif kind == PINGREQ:
+                        conn.sendall(b"\xd0\x00")
+                    elif kind == DISCONNECT:
+                        return
+
+
+def _split_packet(buf):
+    # (type, flags, body, total size) of the first whole packet in buf
+    if len(buf) < 2:
+        return None
+    length = 0
+    shift = 0
+    pos = 1
+    while True:
+        if pos >= len(buf):
+            return None
+        byte = buf[pos]
+        length |= (byte & 0x7F) << shift
+        pos += 1
+        if not byte & 0x80:
+            break
+        shift += 7
+    if len(buf) < pos + length:
+        return None
+    return buf[0] & 0xF0, buf[0] & 0x0F, bytes(buf[pos:pos + length]), pos + length
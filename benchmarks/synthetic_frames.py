@@ -0,0 +1,67 @@
+# Synthetic logger traffic for the benchmarks.
+#
+# Frames are built from the sample registers of the simulator (register.txt),
+# so they have the same register mix and the same one and two byte value
+# encodings as the real pump, with the values jittered around the sample.
+# A share of the frames is corrupted the ways a noisy RS-485 line does it:
+# a flipped bit (checksum error), a cut off frame, or noise between frames.
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nibe_framing import PREAMBLE, build_frame
+from nibe_simulator import sample_registers
+
+
+def jitter_registers(rng):
+    registers = []
+    for reg, value, width in sample_registers:
+        if value:
+            limit = 0xFFFF if width == 2 else 0xFF
+            value = min(max(value + rng.randint(-value // 10 - 1, value // 10 + 1), 1), limit)
+        registers.append((reg, value, width))
+    return registers
+
+
+def corrupt(frame, rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        # One flipped bit in the data, the checksum no longer matches
+        frame = bytearray(frame)
+        i = rng.randrange(4, len(frame) - 1)
+        frame[i] ^= 1 << rng.randrange(8)
+        return bytes(frame)
+    if kind == 1:
+        # Cut off, the parser has to resync on the next preamble
+        return frame[:rng.randrange(4, len(frame) - 1)]
+    # Line noise before the frame
+    return bytes(rng.randrange(0x20, 0x100) for _ in range(rng.randrange(1, 16))) + frame
+
+
+def generate_frames(count, corrupt_ratio=0.05, seed=0):
+    # [(frame bytes, is valid)]
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(count):
+        frame = build_frame(jitter_registers(rng))
+        if rng.random() < corrupt_ratio:
+            frames.append((corrupt(frame, rng), False))
+        else:
+            frames.append((frame, True))
+    return frames
+
+
+def generate_stream(frames, max_read=64, seed=0):
+    # The bytes on the line (preamble before every frame), split into reads
+    # of 1..max_read bytes like the serial port returns them
+    rng = random.Random(seed)
+    stream = b"".join(PREAMBLE + frame for frame, _ in frames)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.randint(1, max_read)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
@@ -1,24 +1,124 @@
+import argparse
+import asyncio
+import json
 import logging
+import os
 import serial
+import threading
 import time
 import paho.mqtt.client as mqtt
-from struct import unpack, pack
+from nibe_aggregate import WindowAggregator
+from nibe_async import run_bridge
+from nibe_capture import CaptureWriter, replay_capture
+from nibe_derived import DerivedMetrics, derived_registers, derived_values
+from nibe_discovery import DiscoveryPublisher, default_state_file, encode_payload
+from nibe_framing import FrameParser, FrameStats, frame_payload, iter_registers
+from nibe_history import RegisterHistory
+from nibe_logging import setup_logging as start_logging
+from nibe_metrics import Metrics, start_metrics_server
+from nibe_modes import OperationModeDecoder, load_operation_modes
+from nibe_mqtt5 import PublishProfile, TopicAliasPublisher
+from nibe_publish import ChangeFilter, Outbox
+from nibe_registers import Register, build_register_table, load_register_map, register_map_definitions
+from nibe_shm import run_reader_processes
+from nibe_snapshot import RegisterSnapshot, SnapshotDocument, start_snapshot_socket
+from nibe_sinks import CallbackSink, InfluxLineSink, JsonStreamSink, SinkDispatcher
+from nibe_sqlite import SQLiteSink
+from nibe_timing import BusTiming, IdleScheduler
 
-# Setup logger
-#logging.basicConfig(level=logging.WARNING)
-logging.basicConfig(level=logging.WARNING, filename='nibe_debug.log', filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
+# Importing this module does no I/O: the log file, the register map, the
+# MQTT connection and the serial ports are set up by setup() and run(), which
+# main() (the command line) calls. The framing, decoding and publishing parts
+# live in the nibe_*.py modules and can be imported on their own.
 logger = logging.getLogger('NIBE')
 
+# Setup logger. Records go through a queue to a listener thread that writes
+# the file (see nibe_logging.py), so a slow SD card never stalls the serial
+# side. The file is rotated at log_max_bytes, repeated warnings are logged
+# once per log_repeat_interval seconds.
+log_file = 'nibe_debug.log'  # None logs to stderr
+log_level = logging.WARNING
+log_max_bytes = 1024 * 1024
+log_backups = 3
+log_repeat_interval = 60
+log_listener = None
+
+def setup_logging():
+    global log_listener
+    #logging.basicConfig(level=logging.WARNING)
+    log_listener = start_logging(log_file, log_level, log_max_bytes, log_backups, log_repeat_interval)
+
 # MQTT setup
-mqtt_client = mqtt.Client()
-mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
-mqtt_client.username_pw_set(username="xxx", password="xxx")
-mqtt_client.will_set("nibe/status", "offline", retain=True)
-mqtt_client.connect("0.0.0.0", 1883, 60)
+mqtt_host = "0.0.0.0"
+mqtt_port = 1883
+mqtt_keepalive = 60
+# Broker login, None for a broker without authentication. Taken from the
+# environment so the password does not have to be written into this file
+# (or given with --mqtt-password, where other users can see it in ps)
+mqtt_username = os.environ.get("NIBE_MQTT_USERNAME")
+mqtt_password = os.environ.get("NIBE_MQTT_PASSWORD")
+# MQTT v5 (mosquitto 1.6 or newer): values of the same topic are sent with a
+# 2 byte topic alias instead of the topic and retained values can expire
+# (see nibe_mqtt5.py)
+mqtt_v5 = False
+mqtt_client = None  # created by setup()
+mqtt_publisher = None
+
+# Publish profiles: QoS, retain and message expiry (seconds, MQTT v5 only)
+# per register. Settings change rarely and are kept retained by the broker,
+# so a client that subscribes later gets them at once, and expire a day after
+# the bridge stopped sending them. Everything else is fast telemetry, sent
+# with QoS 0 and not retained.
+telemetry_profile = PublishProfile(qos=0, retain=False, expiry=None)
+setting_profile = PublishProfile(qos=1, retain=True, expiry=86400)
+publish_profiles = {
+    4: setting_profile,   # heating_curve
+    33: setting_profile,  # max_df_compressor
+    34: setting_profile,  # verd_freq_reg_p
+    35: setting_profile,  # min_start_time_freq_min
+    36: setting_profile,  # min_time_const_freq_min
+    38: setting_profile,  # comp_freq_grad_min
+    40: setting_profile,  # hysteresis
+    43: setting_profile,  # stop_temp_heating_c
+    45: setting_profile,  # bw_reg_p
+    46: setting_profile,  # bw_reg_q
+    47: setting_profile,  # bw_reg_xp
+    48: setting_profile,  # bw_reg_value_xp_percent
+    49: setting_profile,  # domestic_hot_water_start_temp
+    50: setting_profile,  # domestic_hot_water_stop_temp
+}
+
+def create_mqtt_client():
+    global mqtt_client, mqtt_publisher, outbox
+    mqtt_client = mqtt.Client(protocol=mqtt.MQTTv5 if mqtt_v5 else mqtt.MQTTv311)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+    if mqtt_username:
+        mqtt_client.username_pw_set(username=mqtt_username, password=mqtt_password)
+    mqtt_client.will_set("nibe/status", "offline", retain=True)
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    # Values go through the alias publisher with v5, straight to the client otherwise
+    mqtt_publisher = TopicAliasPublisher(mqtt_client) if mqtt_v5 else None
+    outbox = Outbox(mqtt_publisher or mqtt_client, max_topics=outbox_max_topics, max_bytes=outbox_max_bytes)
+
+# The broker handshake runs on the network thread of the client, so the
+# serial ports are read from the start and nothing is lost while the broker
+# is still connecting (values go to the outbox until on_connect)
+def connect_mqtt():
+    mqtt_client.connect_async(mqtt_host, mqtt_port, mqtt_keepalive)
+    mqtt_client.loop_start()
+
+# Messages published while the broker is away are kept in a bounded buffer,
+# latest value per topic only, and flushed in order on reconnect
+outbox_max_topics = 500
+outbox_max_bytes = 256 * 1024
+outbox = None  # created by setup()
 
-def publish_mqtt(topic, message):
-    mqtt_client.publish(topic, message)
-    logger.info(f"Published {message} to {topic}")
+def publish_mqtt(topic, message, profile=telemetry_profile):
+    start = time.perf_counter()
+    outbox.publish(topic, message, profile.qos, profile.retain)
+    publish_seconds.observe(time.perf_counter() - start)
+    logger.info("Published %s to %s", message, topic)
 
 # Publish "online" status to availability topic
 def publish_availability(status):
@@ -27,63 +127,91 @@ def publish_availability(status):
 
 # Serial connection to Nibe heat pump (adjust COM port for Windows)
 serial_port = "/dev/ttyUSB0"  # Adjust to your correct COM port
-ser = serial.Serial(serial_port, 19200, bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE, timeout=3)
-
-logger.debug("Serial port opened successfully")
-
-# Register mapping, expanded to match original script
-nibe_registers = {
-    0: "nibe/cpu_id",
-    1: "nibe/outdoor_temp_c",  
-    4: "nibe/heating_curve",
-    5: "nibe/flow_setpoint_c",  
-    6: "nibe/flow_actual_c",  
-    7: "nibe/return_temp_c",
-    8: "nibe/degree_minutes",
-    12: "nibe/domestic_hot_water_top_temp",
-    25: "nibe/compressor_starts",
-    31: "nibe/heating_status",
-    32: "nibe/additional_heating_allowed",
-    33: "nibe/max_df_compressor",
-    34: "nibe/verd_freq_reg_p",
-    35: "nibe/min_start_time_freq_min",
-    36: "nibe/min_time_const_freq_min",
-    38: "nibe/comp_freq_grad_min",
-    44: "nibe/pump_speed_percent",
-    45: "nibe/bw_reg_p",
-    46: "nibe/bw_reg_q",
-    48: "nibe/bw_reg_value_xp_percent",
-    100: "nibe/date_year",
-    101: "nibe/date_month",
-    102: "nibe/date_day",
-    103: "nibe/time_hour",
-    104: "nibe/time_minute",
-    105: "nibe/time_second",
-    24: "nibe/run_time_compressor_h",
-    9: "nibe/comp_freq_desired_hz",
-    10: "nibe/comp_freq_actual_hz",
-    19: "nibe/high_pressure_bar",
-    20: "nibe/low_pressure_bar",
-    22: "nibe/ams_phase_is_a",
-    40: "nibe/hysteresis",
-    47: "nibe/bw_reg_xp",
-    43: "nibe/stop_temp_heating_c",
-    49: "nibe/domestic_hot_water_start_temp",
-    50: "nibe/domestic_hot_water_stop_temp",
-    28: "nibe/operation_mode_reg_28",
-    29: "nibe/operation_mode_reg_29",
-    30: "nibe/operation_mode_reg_30",
-    23: "nibe/inverter_temp_tho_ip",
-    11: "nibe/condenser_off_max",
-    13: "nibe/domestic_hot_water_bottom",
-    14: "nibe/tho_r1_evap_temp",
-    15: "nibe/tho_r2_evap_temp",
-    16: "nibe/suction_gas_temp_tho_s",
-    17: "nibe/hot_gas_temp_tho_d",
-    18: "nibe/liquid_temp_ams",
-    21: "nibe/resp_at_ams_tho_a",
+# Reads return after this many seconds without data, a frame that stalls
+# for longer than this is dropped and the parser resyncs on the next preamble
+serial_timeout = 0.2
+# A port that can not be opened (adapter missing or busy) or fails is opened
+# again after 1, 2, 4, ... up to serial_retry_max seconds. The other heat
+# pumps keep running meanwhile.
+serial_retry_max = 60
+
+# Raw frame capture and replay (see nibe_capture.py)
+capture_file = None     # e.g. "nibe_frames.cap" to record every validated frame
+replay_file = None      # replay a capture instead of reading the serial port
+replay_realtime = False # replay at the recorded pace instead of as fast as possible
+
+# Run the serial side on an asyncio event loop and decode / publish on a
+# separate worker, so a slow broker can never delay an ACK (see nibe_async.py)
+use_asyncio = False
+
+# Run the serial side of every heat pump in its own process (see nibe_shm.py),
+# which hands the frames to this process through shared memory. Keeps the
+# ACK timing flat however heavy publishing gets.
+use_processes = False
+
+# Heat pumps served by this bridge, one RS-485 adapter each. They all share
+# the MQTT connection, every pump gets its own topic prefix and Home
+# Assistant device. Add an entry per adapter, e.g.
+#    {"serial_port": "/dev/ttyUSB1", "topic_prefix": "nibe2", "device_id": "nibe_heat_pump_2",
+#     "name": "Second Heat Pump", "manufacturer": "Nibe", "model": "ACVM270"},
+# A capture / replay (see above) applies to the first heat pump.
+heat_pumps_config = [
+    {"serial_port": serial_port, "topic_prefix": "nibe", "device_id": "nibe_heat_pump",
+     "name": "Mitsubishi heavy industries Heat Pump", "manufacturer": "MHI", "model": "HMA100v"},
+]
+
+# Change-only publishing: a register value is only published when it has
+# moved by at least its deadband since it was last published, or when
+# heartbeat_interval seconds have passed. Registers without a deadband are
+# published on any change.
+change_only = True
+heartbeat_interval = 300
+publish_deadbands = {
+    1: 0.2, 5: 0.2, 6: 0.2, 7: 0.2, 11: 0.2, 12: 0.2, 13: 0.2,  # temperatures, °C
+    14: 0.2, 15: 0.2, 16: 0.2, 17: 0.2, 18: 0.2, 21: 0.2, 23: 0.2,
+}
+
+# Publish all registers of a frame as one JSON document on state_topic
+# instead of one message per register. The discovery configs then read
+# their value from the document with value_json.
+state_json = False
+state_topic = "state"  # below the topic prefix of each heat pump
+
+# Windowed aggregation: registers listed here are not published on every
+# sample but as <topic>/mean, <topic>/min and <topic>/max at the end of each
+# window (register -> window length in seconds, see nibe_aggregate.py)
+aggregate_windows = {
+#    10: 60,  # comp_freq_actual_hz
+#    22: 60,  # ams_phase_is_a
 }
-  
+
+# Announce the bridge and flush what was kept during an outage. Values are
+# not retained, so send everything again with the next frame after a
+# (re)connect.
+def on_connect(client, userdata, flags, rc, properties=None):
+    if rc != 0:
+        logger.warning(f"MQTT broker refused the connection ({rc})")
+        return
+    if mqtt_publisher is not None:
+        mqtt_publisher.connected(properties)
+        logger.info(f"MQTT v5 connection, {mqtt_publisher.maximum} topic aliases")
+    publish_availability("online")
+    # Without an earlier session the broker may have lost the retained
+    # discovery configs (restart without persistence, new broker), compare
+    # with its copies first. Both wait for the broker, so not on this thread;
+    # the announces of quick reconnects take turns (DiscoveryPublisher.lock).
+    check = not flags.get("session present", 0)
+    if idle is not None:
+        idle.submit(lambda: announce(check), discovery_seconds)
+    else:
+        threading.Thread(target=announce, args=(check,), name="nibe-announce", daemon=True).start()
+    flushed = outbox.connected()
+    logger.info(f"Connected to MQTT broker, flushed {flushed} buffered messages "
+                f"({outbox.coalesced} coalesced, {outbox.dropped} dropped so far)")
+
+def on_disconnect(client, userdata, rc, properties=None):
+    outbox.disconnected()
+    logger.warning(f"Disconnected from MQTT broker ({rc}), buffering messages")
 
 # Define unique IDs and MQTT discovery configurations for each sensor
 mqtt_discovery_sensors = {
@@ -412,235 +540,631 @@ mqtt_discovery_sensors = {
 
 }
 
+# Registers that are not in nibe_registers.py are generated from register.txt
+# and register.html (see nibe_registers.py) and published as
+# nibe/register_<n> with a discovery sensor each. The parsed map is cached in
+# .register_cache.json until one of the two files or the hand written
+# registers change.
+generated_registers = True
+register_map = []  # loaded by setup()
 
-# Publish MQTT discovery payload for each sensor
-def publish_discovery_payloads():
-    for sensor, config in mqtt_discovery_sensors.items():
-        discovery_topic = f"homeassistant/sensor/{config['unique_id']}/config"
-        
-        # Build the base payload
-        payload = {
-            "name": config["name"],
-            "state_topic": config["state_topic"],
-            "unique_id": config["unique_id"],
-            "availability_topic": "nibe/status",
-            "payload_available": "online",
-            "payload_not_available": "offline",
-            "device": {
-                "identifiers": ["nibe_heat_pump"],
-                "name": "Mitsubishi heavy industries Heat Pump",
-                "manufacturer": "MHI",
-                "model": "HMA100v",
-                "sw_version": "1.0"
+def add_generated_sensors(register_map):
+    for register in register_map:
+        if register["generated"] and register["topic"] not in mqtt_discovery_sensors:
+            sensor = {
+                "name": register["name"],
+                "state_topic": register["topic"],
+                "unique_id": register["topic"].replace("/", "_"),
             }
+            if register["unit"]:
+                sensor["unit_of_measurement"] = register["unit"]
+            if register["unit"] == "°C":
+                sensor["device_class"] = "temperature"
+            mqtt_discovery_sensors[register["topic"]] = sensor
+
+
+# Operation mode from registers 28, 29 and 30, the known combinations are in
+# operation_modes.json (see nibe_modes.py). Registers 28 and 29 only update
+# the decoder, register 30 (last of the three in a frame) decodes to the mode.
+# With change_only the mode is published only when it changes.
+operation_modes = ({}, [])  # loaded by setup()
+
+# Values derived on the bridge (see nibe_derived.py): flow / return delta T,
+# compressor duty cycle over derived_window seconds and cycle lengths,
+# compressor starts per hour and defrosts per day. Published as
+# nibe/<name> like the registers, with a discovery sensor each.
+derived_metrics = True
+derived_window = 3600
+defrost_modes = ("Sulatus",)  # operation modes that count as defrost
+
+derived_discovery_sensors = {
+    "nibe/delta_t_c": {
+        "name": "Flow Return Delta T",
+        "unit_of_measurement": "°C",
+        "state_topic": "nibe/delta_t_c",
+        "unique_id": "nibe_delta_t_c"
+    },
+    "nibe/compressor_duty_percent": {
+        "name": "Compressor Duty Cycle",
+        "unit_of_measurement": "%",
+        "state_topic": "nibe/compressor_duty_percent",
+        "unique_id": "nibe_compressor_duty_percent"
+    },
+    "nibe/compressor_on_minutes": {
+        "name": "Compressor On Cycle",
+        "unit_of_measurement": "min",
+        "state_topic": "nibe/compressor_on_minutes",
+        "unique_id": "nibe_compressor_on_minutes"
+    },
+    "nibe/compressor_off_minutes": {
+        "name": "Compressor Off Cycle",
+        "unit_of_measurement": "min",
+        "state_topic": "nibe/compressor_off_minutes",
+        "unique_id": "nibe_compressor_off_minutes"
+    },
+    "nibe/compressor_starts_per_hour": {
+        "name": "Compressor Starts Per Hour",
+        "unit_of_measurement": "1/h",
+        "state_topic": "nibe/compressor_starts_per_hour",
+        "unique_id": "nibe_compressor_starts_per_hour"
+    },
+    "nibe/defrosts_per_day": {
+        "name": "Defrosts Per Day",
+        "state_topic": "nibe/defrosts_per_day",
+        "unique_id": "nibe_defrosts_per_day"
+    },
+    "nibe/defrost_interval_minutes": {
+        "name": "Defrost Interval",
+        "unit_of_measurement": "min",
+        "state_topic": "nibe/defrost_interval_minutes",
+        "unique_id": "nibe_defrost_interval_minutes"
+    },
+}
+
+# Recent history of every numeric register in memory, history_size samples
+# per register in a ring buffer (see nibe_history.py). heat_pump.history.get(reg)
+# answers last_minutes(), stats() and rate() queries. 0 disables it.
+history_size = 3600
+
+# Local history of every numeric register value in an SQLite database (see
+# nibe_sqlite.py), e.g. "nibe_history.db". Written in batches by a background
+# thread, raw samples older than sqlite_downsample_days are reduced to
+# mean / min / max per sqlite_downsample_interval seconds.
+sqlite_file = None
+sqlite_retention_days = 365
+sqlite_downsample_days = 7
+sqlite_downsample_interval = 300
+sqlite_sink = None
+
+# Outputs of the decoded values (see nibe_sinks.py). MQTT is always there,
+# influx_file appends InfluxDB line protocol (e.g. for Telegraf), json_stream
+# writes one JSON document per frame to a file ("-" for stdout). Each output
+# has its own worker thread and a queue of sink_queue_size frames; when it
+# falls behind sink_drop ("oldest" or "newest") decides which frame is lost.
+influx_file = None
+json_stream = None
+sink_queue_size = 1000
+sink_drop = "oldest"
+sinks = None
+
+# Bus timing (see nibe_timing.py): the frame interval, jitter and ACK
+# turnaround of every heat pump are measured and the next frame is predicted.
+# With idle_scheduling, discovery republishing, aggregation flushes and
+# SQLite commits wait for the quiet gap between two frames, keeping
+# idle_guard seconds free before the next frame, but never longer than
+# idle_max_delay seconds.
+idle_scheduling = True
+idle_guard = 0.05
+idle_max_delay = 5.0
+discovery_seconds = 0.1  # expected time to publish the discovery configs
+aggregate_flush_seconds = 0.01
+idle = None
+
+# Prometheus metrics of the hot path (see nibe_metrics.py), served on
+# http://127.0.0.1:<metrics_port>/metrics when metrics_port is set. Counters
+# are per heat pump (device label).
+metrics_port = None  # e.g. 9105
+metrics = Metrics()
+
+# Latest value of every register (see nibe_snapshot.py), as one JSON
+# document on the Unix socket snapshot_socket and on
+# http://127.0.0.1:<metrics_port>/state
+snapshot_socket = None  # e.g. "nibe_state.sock"
+snapshot_server = None
+state_document = None
+ack_seconds = metrics.histogram("nibe_ack_turnaround_seconds", "Time from reading the last byte of a preamble or frame to writing its ACK")
+decode_seconds = metrics.histogram("nibe_frame_decode_seconds", "Time to decode a frame and hand its values to the publisher")
+publish_seconds = metrics.histogram("nibe_publish_seconds", "Time spent in one MQTT publish call")
+
+def _per_heat_pump(func):
+    return lambda: {heat_pump.topic_prefix: func(heat_pump) for heat_pump in heat_pumps}
+
+metrics.counter("nibe_frames_total", "Frames received with a valid checksum", _per_heat_pump(lambda h: h.stats.frames))
+metrics.counter("nibe_crc_errors_total", "Frames dropped because of a checksum error", _per_heat_pump(lambda h: h.stats.crc_errors))
+metrics.counter("nibe_resyncs_total", "Frames given up half way, parser resynced on the next preamble", _per_heat_pump(lambda h: h.stats.resyncs))
+metrics.counter("nibe_handler_errors_total", "Frames the bridge failed to handle after receiving them", _per_heat_pump(lambda h: h.stats.handler_errors))
+metrics.counter("nibe_bytes_discarded_total", "Bytes skipped while looking for a preamble", _per_heat_pump(lambda h: h.stats.bytes_discarded))
+metrics.counter("nibe_frames_dropped_total", "Frames dropped because the publish queue was full", _per_heat_pump(lambda h: h.stats.frames_dropped))
+metrics.gauge("nibe_publish_queue_depth", "Frames waiting for the publisher (asyncio runtime)", _per_heat_pump(lambda h: h.stats.queue_depth))
+metrics.counter("nibe_values_suppressed_total", "Values not published by the change filter", _per_heat_pump(lambda h: h.change_filter.suppressed))
+metrics.gauge("nibe_outbox_pending", "Messages buffered while the broker is away", lambda: len(outbox.pending))
+metrics.counter("nibe_outbox_coalesced_total", "Buffered messages replaced by a newer value of the same topic", lambda: outbox.coalesced)
+metrics.counter("nibe_outbox_dropped_total", "Buffered messages dropped because the buffer was full", lambda: outbox.dropped)
+metrics.counter("nibe_mqtt_aliased_total", "Messages sent with the topic alias only (MQTT v5)", lambda: mqtt_publisher.aliased if mqtt_publisher else 0)
+metrics.counter("nibe_sink_batches_written_total", "Frames written by an output", lambda: {w.sink.name: w.written for w in sinks.workers} if sinks else {}, label="sink")
+metrics.counter("nibe_sink_batches_dropped_total", "Frames an output dropped because its queue was full", lambda: {w.sink.name: w.dropped for w in sinks.workers} if sinks else {}, label="sink")
+metrics.gauge("nibe_sink_queue_depth", "Frames waiting for an output", lambda: {w.sink.name: w.queue.qsize() for w in sinks.workers} if sinks else {}, label="sink")
+metrics.counter("nibe_sqlite_rows_written_total", "Register values written to the SQLite history", lambda: sqlite_sink.written if sqlite_sink else 0)
+metrics.gauge("nibe_frame_interval_seconds", "Median time between two frames", _per_heat_pump(lambda h: h.timing.interval or 0))
+metrics.gauge("nibe_frame_jitter_seconds", "Median deviation of the frame interval", _per_heat_pump(lambda h: h.timing.jitter))
+metrics.gauge("nibe_ack_turnaround_max_seconds", "Longest ACK turnaround so far", _per_heat_pump(lambda h: h.timing.ack_max))
+metrics.counter("nibe_idle_work_in_gap_total", "Background work run in a quiet gap between frames", lambda: idle.in_gap if idle else 0)
+metrics.counter("nibe_idle_work_forced_total", "Background work run without a quiet gap after idle_max_delay", lambda: idle.forced if idle else 0)
+metrics.counter("nibe_sqlite_rows_dropped_total", "Register values dropped because the SQLite writer fell behind", lambda: sqlite_sink.dropped if sqlite_sink else 0)
+
+
+def state_field(topic):
+    # Name of a register in the state document, e.g. nibe/flow_actual_c -> flow_actual_c
+    return topic.rsplit("/", 1)[-1]
+
+
+class HeatPump:
+    # One heat pump on its own RS-485 adapter: serial port, parser state,
+    # operation mode, topics and discovery identifiers. The topics and ids in
+    # nibe_registers.py / mqtt_discovery_sensors are written for the "nibe"
+    # prefix and are rewritten for other prefixes.
+    def __init__(self, config):
+        self.config = config
+        self.serial_port = config["serial_port"]
+        self.topic_prefix = config.get("topic_prefix", "nibe")
+        self.device = {
+            "identifiers": [config.get("device_id", f"{self.topic_prefix}_heat_pump")],
+            "name": config.get("name", "Nibe Heat Pump"),
+            "manufacturer": config.get("manufacturer", "Nibe"),
+            "model": config.get("model", ""),
+            "sw_version": "1.0"
         }
+        self.ser = None
+        # Frame timing, also takes the ACK turnaround of the parser
+        self.timing = BusTiming(ack_latency=ack_seconds)
+        self.stats = FrameStats(ack_latency=self.timing)
 
-        # Add optional fields only if they exist
-        if config.get("unit_of_measurement"):
-            payload["unit_of_measurement"] = config["unit_of_measurement"]
-        if config.get("device_class"):
-            payload["device_class"] = config["device_class"]
-        if config.get("value_template"):
-            payload["value_template"] = config["value_template"]
-
-        # Publish the discovery payload as JSON
-        mqtt_client.publish(discovery_topic, str(payload).replace("'", '"'), qos=0, retain=True)
-        logger.info(f"Published MQTT discovery payload for {config['name']}")
-
-# Initialize global variables to store register 28, 29, and 30 values
-reg28_value = None
-reg29_value = None
-reg30_value = None
-
-def _decode(reg, raw):
-    global reg28_value, reg29_value, reg30_value  # Ensure these variables are accessible
-    
-    if len(raw) == 2:
-        value = unpack('>H', raw)[0]
-    else:
-        value = unpack('B', raw)[0]
-
-    # Handle registers 28, 29, and 30
-    if reg == 28:
-        reg28_value = value
-        logger.debug(f"Register 28 (operation mode) value: {reg28_value}")
-        return None  # Avoid falling through to unhandled case
-    elif reg == 29:
-        reg29_value = value
-        logger.debug(f"Register 29 (operation mode) value: {reg29_value}")
-        return None  # Avoid falling through to unhandled case
-    elif reg == 30:
-        reg30_value = value
-        logger.debug(f"Register 30 (operation mode) value: {reg30_value}")
-
-        # Now that we have all three registers, interpret the state
-        if reg28_value == 0x0000 and reg29_value == 0x8222 and reg30_value == 0x0032:
-            publish_mqtt("nibe/operation_mode", "Pois päältä") #pwer on, heatpump off
-        elif reg28_value == 0x4409 and reg29_value == 0xA22A and reg30_value == 0x01FE:
-            publish_mqtt("nibe/operation_mode", "Käyttövesi") #domestic water
-        elif reg28_value == 0x0008 and reg29_value == 0xC22A and reg30_value == 0x000A:
-            publish_mqtt("nibe/operation_mode", "Pois päältä") #power on, heatpump off
-        elif reg28_value == 26634 and reg29_value == 49706 and reg30_value == 170:
-            publish_mqtt("nibe/operation_mode", "Öljy paluu") #oil return
-        elif reg28_value == 16394 and reg29_value == 49706 and reg30_value == 610:
-            publish_mqtt ("nibe/operation_mode", "Lämmitys") #heating
-        elif reg28_value == 16394 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt ("nibe/operation_mode", "Lämmitys") #heating
-        elif reg28_value == 16650 and reg29_value == 49706 and reg30_value == 610:
-            publish_mqtt ("nibe/operation_mode", "Lämmitys") #heating
-        elif reg28_value == 0x0000 and reg29_value == 0xC22A and reg30_value == 0x003C:
-            publish_mqtt("nibe/operation_mode", "Vain sähkövastukset") #additional heating only
-        elif reg28_value == 16385 and reg29_value == 41514 and reg30_value == 50:
-            publish_mqtt("nibe/operation_mode", "Käyttövesi") #domestic water
-        elif reg28_value == 16393 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt("nibe/operation_mode", "Lämmitys") # heating
-        elif reg28_value == 10 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt("nibe/operation_mode", "Pois päältä") #power on, heatpump off
-        elif reg28_value == 28 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt("nibe/operation_mode", "lämmitys") #heating
-        elif reg28_value == 10 and reg29_value == 49706 and reg30_value == 610:
-            publish_mqtt("nibe/operation_mode", "Pois päältä") #power on, heatpump off
-        elif reg28_value == 32776 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt("nibe/operation_mode", "Jäätymisensuoja") #freeze protection
-        elif reg28_value == 32778 and reg29_value == 49706 and reg30_value == 10:
-            publish_mqtt("nibe/operation_mode", "Jäätymisensuoja") #freeze protection
-        elif reg28_value == 17419 and reg29_value == 41514 and reg30_value == 510:
-            publish_mqtt("nibe/operation_mode", "Käyttövesi") #domestic water
-        elif reg28_value == 17425 and reg29_value == 41514 and reg30_value == 450:
-            publish_mqtt("nibe/operation_mode", "LisäLV") #extra domestic water
-        elif reg28_value == 24586 and reg29_value == 49706 and reg30_value == 270:
-            publish_mqtt("nibe/operation_mode", "Sulatus") #defrost
-        elif reg28_value == 24842 and reg29_value == 49706 and reg30_value == 270:
-            publish_mqtt("nibe/operation_mode", "Sulatus") #defrost
-        elif reg28_value == 17409 and reg29_value == 41514 and reg30_value == 30:
-            publish_mqtt("nibe/operation_mode", "Käyttövesi") #domestic water
-        else:
-            logger.warning(f"Unknown combination of register values: reg28={reg28_value}, reg29={reg29_value}, reg30={reg30_value}")
-            publish_mqtt("nibe/operation_mode", f"Unknown mode: reg28={reg28_value}, reg29={reg29_value}, reg30={reg30_value}")
-        return None  # Avoid falling through to unhandled case
-
-    # Handle additional heating using nibe/additional_heating_allowed
-    if reg == 32:
-        logger.debug(f"Register 32 (additional heating allowed) value: {value}")
-        publish_mqtt("nibe/additional_heating_allowed", str(value))
-        return None
-
-    # Handle heating status using register 31
-    if reg == 31:
-        logger.debug(f"Register 31 (heating status) value: {value}")
-        if value == 1:
-            publish_mqtt("nibe/heating_status", "auto")
-        elif value == 3:
-            publish_mqtt("nibe/heating_status", "lämmitys") #heating
-        elif value == 5:
-            publish_mqtt("nibe/heating_status", "lämminvesi") #domestic water
-        elif value == 6:
-            publish_mqtt("nibe/heating_status", "lisäys (sähkö)") #additional heating
-        return None
-
-    # Handle temperature and flow registers
-    if reg in [1, 5, 6, 7, 12, 23, 11, 13, 14, 15, 16, 17, 18, 21]:
-        logger.debug(f"Register {reg} (temperature/flow) value: {value}")
-        return float(unpack('h', pack('H', value))[0] / 10)
-
-    # Handle general integer registers
-    if reg in [0, 33, 34, 35, 36, 38, 44, 45, 46, 48, 100, 101, 102, 103, 104, 105]:
-        logger.debug(f"Register {reg} (general integer) value: {value}")
-        return int(value)
-
-    # Handle signed values for heating curve and degree minutes
-    if reg in [4, 8]:
-        logger.debug(f"Register {reg} (signed value) value: {value}")
-        return int(unpack('h', pack('H', value))[0] / 10)
-
-    # Handle compressor starts
-    if reg == 25:
-        logger.debug(f"Register 25 (compressor starts) value: {value}")
-        return int(value / 10)
-
-    # Handle frequency, pressure, phase, and runtime registers
-    if reg in [9, 10, 19, 20, 22, 24]:
-        logger.debug(f"Register {reg} (frequency/pressure) value: {value}")
-        return float(value / 10)
-
-    # Handle hysteresis and BW registers
-    if reg in [40, 47]:
-        logger.debug(f"Register {reg} (hysteresis/BW reg) value: {value}")
-        return float(value / 2)
-
-    # Handle stop temperature and domestic water temperatures
-    if reg in [43, 49, 50]:
-        logger.debug(f"Register {reg} (temperature) value: {value}")
-        return float(value)
-
-    # Log unknown registers
-    logger.warning(f"Register {reg} is not handled")
-    return None
+        # Register descriptor table (see nibe_registers.py), indexed by register number
+        self.register_table = [
+            None if entry is None else entry._replace(topic=self.topic(entry.topic))
+            for entry in build_register_table(register_map_definitions(register_map))
+        ]
+        self.operation_mode = OperationModeDecoder(*operation_modes)
+        self.register_table[28] = self.register_table[28]._replace(decode=self.operation_mode.decode_reg28)
+        self.register_table[29] = self.register_table[29]._replace(decode=self.operation_mode.decode_reg29)
+        self.register_table[30] = self.register_table[30]._replace(topic=self.topic("nibe/operation_mode"), decode=self.operation_mode.decode_reg30)
 
+        self.change_filter = ChangeFilter(
+            {self.register_table[reg].topic: deadband for reg, deadband in publish_deadbands.items()},
+            heartbeat=heartbeat_interval,
+        )
+        # Publish profile per topic, registers without one are telemetry
+        self.profiles = {self.register_table[reg].topic: profile for reg, profile in publish_profiles.items()}
+        self.aggregator = WindowAggregator(
+            {self.register_table[reg].topic: window for reg, window in aggregate_windows.items()}
+        ) if aggregate_windows else None
+        self.flush_deferred = None
+        self.history = RegisterHistory(history_size) if history_size else None
+        self.derived = DerivedMetrics(derived_window, defrost_modes) if derived_metrics else None
+        # Table entries for the derived values, they have no register number
+        self.derived_entries = {
+            name: Register(None, self.topic(f"nibe/{name}"), 0, False, 1, None) for name in derived_values
+        }
+        # Latest raw / decoded value of every register, written by decode_frame
+        self.snapshot = RegisterSnapshot([None if entry is None else state_field(entry.topic) for entry in self.register_table])
+        self._discovery_messages = None
 
+    def topic(self, topic):
+        # nibe/<name> -> <topic_prefix>/<name>
+        return f"{self.topic_prefix}/{topic.split('/', 1)[1]}"
 
+    def unique_id(self, unique_id):
+        if self.topic_prefix == "nibe":
+            return unique_id
+        return f"{self.topic_prefix}_{unique_id.split('_', 1)[1]}"
 
-def run():
-    logger.info("Starting the main loop...")
+    def open(self):
+        self.ser = serial.Serial(self.serial_port, 19200, bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE, timeout=serial_timeout)
+        logger.debug(f"Serial port {self.serial_port} opened successfully")
 
-    # Publish availability as "online" at the start of the script
-    publish_availability("online")
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = None
 
-    # Publish discovery payloads for all sensors
-    publish_discovery_payloads()
+    # Discovery configs of all sensors as [(topic, JSON bytes)], built once
+    def discovery_messages(self):
+        if self._discovery_messages is not None:
+            return self._discovery_messages
+        messages = []
+        for sensor, config in mqtt_discovery_sensors.items():
+            unique_id = self.unique_id(config["unique_id"])
+            discovery_topic = f"homeassistant/sensor/{unique_id}/config"
+            
+            # Build the base payload
+            payload = {
+                "name": config["name"],
+                "state_topic": self.topic(config["state_topic"]),
+                "unique_id": unique_id,
+                "availability_topic": "nibe/status",
+                "payload_available": "online",
+                "payload_not_available": "offline",
+                "device": self.device
+            }
 
-    mqtt_client.loop_start()
-    try:
+            # Add optional fields only if they exist
+            if config.get("unit_of_measurement"):
+                payload["unit_of_measurement"] = config["unit_of_measurement"]
+            if config.get("device_class"):
+                payload["device_class"] = config["device_class"]
+            if config.get("value_template"):
+                payload["value_template"] = config["value_template"]
+
+            # Aggregated registers: the sensor shows the mean, plus min and max sensors
+            if self.aggregator is not None and payload["state_topic"] in self.aggregator.windows:
+                for suffix in ("mean", "min", "max"):
+                    variant = dict(payload)
+                    variant["state_topic"] = f"{payload['state_topic']}/{suffix}"
+                    if suffix != "mean":
+                        variant["name"] = f"{config['name']} {suffix}"
+                        variant["unique_id"] = f"{unique_id}_{suffix}"
+                    messages.append((f"homeassistant/sensor/{variant['unique_id']}/config", encode_payload(variant)))
+                continue
+
+            # Read the value from the field of the state document
+            if state_json:
+                field = state_field(config["state_topic"])
+                payload["state_topic"] = f"{self.topic_prefix}/{state_topic}"
+                payload["value_template"] = payload.get("value_template", "{{ value }}").replace("value", f"value_json.{field}", 1)
+
+            messages.append((discovery_topic, encode_payload(payload)))
+        self._discovery_messages = messages
+        return messages
+
+    def decode_frame(self, frame):
+        # (register entry, value) of every register of a validated frame that has
+        # something to publish, numeric values also go to the register history.
+        # Derived values follow the register they were derived from, the ones of
+        # several registers (delta T) come at the end of the frame.
+        values = []
+        now = time.time()
+        register_table = self.register_table
+        history = self.history
+        derived = self.derived
+        snapshot = self.snapshot
+        update_snapshot = snapshot.update
+        for reg, raw in iter_registers(frame_payload(frame)):
+            entry = register_table[reg]
+            value = None
+            if entry is not None:
+                value = entry.decode(raw)
+                if value is not None:
+                    values.append((entry, value))
+                    if history is not None:
+                        history.record(reg, value, now)
+                    if derived is not None and reg in derived_registers:
+                        for name, derived_value in derived.update(reg, value, now):
+                            values.append((self.derived_entries[name], derived_value))
+                            snapshot.update_derived(name, derived_value, now)
+            # Unhandled registers are kept with their raw value only
+            update_snapshot(reg, raw, value, now)
+        if derived is not None:
+            for name, derived_value in derived.end_frame():
+                values.append((self.derived_entries[name], derived_value))
+                snapshot.update_derived(name, derived_value, now)
+        snapshot.frame(now)
+        return values
+
+    def publish_state(self, values):
+        # Publish the values of a frame as one JSON document, with change_only
+        # only when at least one value passed the change filter
+        now = time.monotonic()
+        state = {}
+        changed = not change_only
+        for entry, value in values:
+            state[state_field(entry.topic)] = value
+            if change_only and self.change_filter.changed(entry.topic, value, now):
+                changed = True
+        if changed and state:
+            publish_mqtt(f"{self.topic_prefix}/{state_topic}", json.dumps(state, ensure_ascii=False, separators=(",", ":")))
+
+    def publish_registers(self, values):
+        # Publish the values of a frame, one topic per register
+        now = time.monotonic()
+        change_filter = self.change_filter
+        profiles = self.profiles
+        for entry, value in values:
+            if not change_only or change_filter.changed(entry.topic, value, now):
+                publish_mqtt(entry.topic, value, profiles.get(entry.topic, telemetry_profile))
+
+    def aggregate(self, values):
+        # Aggregated registers go to their window instead of being published,
+        # windows that have ended are published in the next quiet gap between
+        # frames (at most idle_max_delay seconds late)
+        now = time.time()
+        aggregator = self.aggregator
+        values = [(entry, value) for entry, value in values if not aggregator.add(entry.topic, value, now)]
+        if idle is not None and not idle.idle(aggregate_flush_seconds):
+            if self.flush_deferred is None:
+                self.flush_deferred = now
+            if now - self.flush_deferred < idle_max_delay:
+                return values
+        self.flush_deferred = None
+        for topic, payload in aggregator.flush(now):
+            publish_mqtt(topic, payload)
+        return values
+
+    def publish_values(self, values):
+        # MQTT output of the values of a frame, runs on the worker of the
+        # MQTT sink
+        if self.aggregator is not None:
+            values = self.aggregate(values)
+        if state_json:
+            self.publish_state(values)
+        else:
+            self.publish_registers(values)
+
+    def handle_frame(self, frame):
+        # Decodes a frame and hands the values to the outputs, which write
+        # them on their own threads
+        self.timing.frame()
+        start = time.perf_counter()
+        now = time.time()
+        values = self.decode_frame(frame)
+        if sqlite_sink is not None:
+            sqlite_sink.record(self.topic_prefix, now, [(entry.number, value) for entry, value in values if entry.number is not None])
+        sinks.dispatch(self, now, values)
+        decode_seconds.observe(time.perf_counter() - start)
+        if idle is not None:
+            idle.frame()
+
+    def read_serial(self, on_frame):
+        # Synchronous read loop of this heat pump, runs until interrupted. The
+        # port is opened here, on the reader thread of the heat pump, and
+        # opened again with backoff when it fails. Errors of on_frame are
+        # counted by the parser (stats.handler_errors) and never reach this
+        # loop, so only opening, reading and the ACKs close the port.
+        parser = FrameParser(lambda data: self.ser.write(data), on_frame, self.stats)
+        delay = 1
         while True:
             try:
-                if ser.read(1)[0] != 0x03:
-                    logger.debug("No start byte found")
-                    continue
-                logger.debug("Start byte found, reading data...")
-                ret = ser.read(2)
-                if ret[0] != 0x00 or ret[1] != 0x14:
-                    logger.debug("Invalid start frame")
-                    continue
-                ser.write(b"\x06")
-                frm = ser.read(4)
-                if frm[0] == 0x03:
-                    continue
-                l = int(frm[3])
-                frm += ser.read(l + 1)
-                ser.write(b"\x06")
-                crc = 0
-                for i in frm[:-1]:
-                    crc ^= i
-                if crc != frm[-1]:
-                    logger.warning("Frame CRC error")
-                    continue
-                msg = frm[4:-1]
-                l = len(msg)
-                i = 4
-                while i <= l:
-                    reg = msg[i - 3]
-                    if i != l and (msg[i] == 0x00 or i == (l - 1)):
-                        raw = bytes([msg[i - 2], msg[i - 1]])
-                        i += 4
-                    else:
-                        raw = bytes([msg[i - 2]])
-                        i += 3
-                    if reg in nibe_registers:
-                        value = _decode(reg, raw)
-                        if value is not None:
-                            mqtt_topic = nibe_registers[reg]
-                            publish_mqtt(mqtt_topic, value)
+                if self.ser is None:
+                    self.open()
+                    # Bytes of the old port are not continued on the new one
+                    parser.reset()
+                # Read everything that is waiting in one go, at least one byte
+                data = self.ser.read(self.ser.in_waiting or 1)
+                if data:
+                    delay = 1
+                    parser.feed(data)
+                else:
+                    parser.idle()
+            except (serial.SerialException, OSError) as e:
+                logger.warning("Serial port %s failed, opening it again in %s s: %s", self.serial_port, delay, e)
+                self.close()
+                time.sleep(delay)
+                delay = min(delay * 2, serial_retry_max)
             except Exception as e:
-                logger.warning(f"Error in Nibe data processing: {e}")
+                logger.warning("Error in Nibe data processing (%s): %s", self.serial_port, e)
                 time.sleep(1)
+
+heat_pumps = []  # created by setup()
+
+# Discovery configs are only republished when they changed, the hashes of the
+# published ones are kept in discovery_state_file (see nibe_discovery.py),
+# next to this script
+discovery_state_file = default_state_file
+discovery = None
+
+# Publish the discovery payloads of every heat pump that changed since the last start
+def publish_discovery():
+    messages = [message for heat_pump in heat_pumps for message in heat_pump.discovery_messages()]
+    count = discovery.publish(messages)
+    logger.info(f"Published {count} MQTT discovery payloads, {discovery.unchanged} unchanged")
+
+# Discovery first, then everything again with the next frame (values are not
+# retained), also for the entities Home Assistant has just learned about
+def announce(check_broker=False):
+    if check_broker:
+        discovery.check_broker([topic for heat_pump in heat_pumps for topic, _ in heat_pump.discovery_messages()])
+    publish_discovery()
+    for heat_pump in heat_pumps:
+        heat_pump.change_filter.forget()
+
+
+# Loads the register map and the operation modes and creates the heat pumps
+# from the configuration above
+def setup():
+    global register_map, operation_modes, heat_pumps, discovery, sqlite_sink, sinks, idle, state_document
+    if generated_registers:
+        register_map = load_register_map()
+        add_generated_sensors(register_map)
+    if derived_metrics:
+        mqtt_discovery_sensors.update(derived_discovery_sensors)
+    operation_modes = load_operation_modes()
+    heat_pumps = [HeatPump(config) for config in heat_pumps_config]
+    state_document = SnapshotDocument({heat_pump.topic_prefix: heat_pump.snapshot for heat_pump in heat_pumps})
+    if idle_scheduling:
+        idle = IdleScheduler([heat_pump.timing for heat_pump in heat_pumps], idle_guard, idle_max_delay)
+    create_mqtt_client()
+    if mqtt_publisher is not None:
+        for heat_pump in heat_pumps:
+            mqtt_publisher.expiries.update({topic: profile.expiry for topic, profile in heat_pump.profiles.items() if profile.expiry})
+    discovery = DiscoveryPublisher(mqtt_client, discovery_state_file)
+    if sqlite_file:
+        sqlite_sink = SQLiteSink(sqlite_file, retention=sqlite_retention_days * 86400,
+                                 downsample_after=sqlite_downsample_days * 86400,
+                                 downsample_interval=sqlite_downsample_interval, idle=idle)
+    sinks = SinkDispatcher()
+    sinks.add(CallbackSink("mqtt", lambda heat_pump, timestamp, values: heat_pump.publish_values(values)), sink_queue_size, sink_drop)
+    if influx_file:
+        sinks.add(InfluxLineSink(influx_file), sink_queue_size, sink_drop)
+    if json_stream:
+        sinks.add(JsonStreamSink(None if json_stream == "-" else json_stream), sink_queue_size, sink_drop)
+
+
+def run():
+    global snapshot_server
+    logger.info("Starting the main loop...")
+    if not heat_pumps:
+        setup()
+
+    # Availability "online" and the discovery payloads are published from
+    # on_connect, once the broker has accepted the connection
+    if idle is not None:
+        idle.start()
+    connect_mqtt()
+
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port, state=state_document.render)
+    if snapshot_socket:
+        snapshot_server = start_snapshot_socket(snapshot_socket, state_document.render)
+    sinks.start()
+    if sqlite_sink is not None:
+        sqlite_sink.start()
+        logger.info(f"Writing the register history to {sqlite_file}")
+
+    # Frame handler per heat pump, the first one also feeds the capture
+    handlers = [heat_pump.handle_frame for heat_pump in heat_pumps]
+    capture = None
+    if capture_file:
+        capture = CaptureWriter(capture_file)
+        logger.info(f"Capturing frames to {capture_file}")
+
+        def capture_frame(frame):
+            capture.write(frame)
+            heat_pumps[0].handle_frame(frame)
+
+        handlers[0] = capture_frame
+
+    try:
+        if replay_file:
+            start = time.monotonic()
+            parser = replay_capture(replay_file, handlers[0], realtime=replay_realtime, stats=heat_pumps[0].stats)
+            logger.info(f"Replayed {parser.stats.frames} frames from {replay_file} in {time.monotonic() - start:.2f} s")
+            return
+        if use_processes:
+            # Reader processes open the ports, this process decodes and publishes
+            run_reader_processes([heat_pump.serial_port for heat_pump in heat_pumps], handlers,
+                                 [heat_pump.stats for heat_pump in heat_pumps], timeout=serial_timeout, log_level=log_level)
+            return
+        if use_asyncio:
+            # One reader and one publisher task per heat pump on the same
+            # loop, every heat pump opens its port and reopens it with backoff
+            async def run_heat_pump(heat_pump, handler):
+                delay = 1
+                while True:
+                    frames = heat_pump.stats.frames
+                    try:
+                        heat_pump.open()
+                        await run_bridge(heat_pump.ser, handler, idle_timeout=serial_timeout, stats=heat_pump.stats)
+                    except Exception as e:
+                        logger.warning("Serial port %s failed, opening it again in %s s: %s", heat_pump.serial_port, delay, e)
+                    heat_pump.close()
+                    if heat_pump.stats.frames != frames:
+                        delay = 1
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, serial_retry_max)
+
+            async def run_all():
+                await asyncio.gather(*(
+                    run_heat_pump(heat_pump, handler) for heat_pump, handler in zip(heat_pumps, handlers)
+                ))
+
+            while True:
+                try:
+                    asyncio.run(run_all())
+                except Exception as e:
+                    logger.warning("Error in Nibe data processing: %s", e)
+                    time.sleep(1)
+        # One reader thread per heat pump
+        threads = [
+            threading.Thread(target=heat_pump.read_serial, args=(handler,), name=f"nibe-{heat_pump.topic_prefix}", daemon=True)
+            for heat_pump, handler in zip(heat_pumps, handlers)
+        ]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
     except KeyboardInterrupt:
         logger.info("Script interrupted, shutting down...")
     finally:
-        # Publish availability as "offline" when the script is stopped
+        # Let the outputs write what they have, then publish availability as
+        # "offline" when the script is stopped
+        sinks.close()
+        if idle is not None:
+            idle.close()
         publish_availability("offline")
+        if capture:
+            capture.close()
+        if sqlite_sink is not None:
+            sqlite_sink.close()
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
+        if snapshot_server is not None:
+            snapshot_server.shutdown()
+            snapshot_server.server_close()
+            os.remove(snapshot_socket)
 
-if __name__ == "__main__":
+def main(argv=None):
+    global mqtt_host, mqtt_port, mqtt_username, mqtt_password, mqtt_v5, replay_file, replay_realtime, capture_file, use_asyncio, use_processes, metrics_port, snapshot_socket, log_file, log_level, sqlite_file, influx_file, json_stream
+    parser = argparse.ArgumentParser(description="Nibe heat pump RS-485 logger to MQTT bridge")
+    parser.add_argument("--serial-port", help=f"serial port of the first heat pump (default {heat_pumps_config[0]['serial_port']})")
+    parser.add_argument("--mqtt-host", default=mqtt_host, help=f"MQTT broker (default {mqtt_host})")
+    parser.add_argument("--mqtt-port", type=int, default=mqtt_port, help=f"MQTT broker port (default {mqtt_port})")
+    parser.add_argument("--mqtt-username", default=mqtt_username, help="MQTT user name (default $NIBE_MQTT_USERNAME)")
+    parser.add_argument("--mqtt-password", default=mqtt_password, help="MQTT password (default $NIBE_MQTT_PASSWORD)")
+    parser.add_argument("--mqtt-v5", action="store_true", default=mqtt_v5, help="use MQTT v5 with topic aliases and message expiry")
+    parser.add_argument("--replay", metavar="CAPTURE", default=replay_file, help="replay a capture file instead of reading the serial port")
+    parser.add_argument("--realtime", action="store_true", default=replay_realtime, help="replay at the recorded pace")
+    parser.add_argument("--capture", metavar="CAPTURE", default=capture_file, help="record every validated frame to a capture file")
+    parser.add_argument("--asyncio", action="store_true", default=use_asyncio, help="run the serial side on an asyncio event loop")
+    parser.add_argument("--processes", action="store_true", default=use_processes, help="read the serial ports in separate processes")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port, help="serve Prometheus metrics on this port")
+    parser.add_argument("--state-socket", metavar="PATH", default=snapshot_socket, help="serve the latest register values as JSON on this Unix socket")
+    parser.add_argument("--sqlite", metavar="DATABASE", default=sqlite_file, help="keep the register history in an SQLite database")
+    parser.add_argument("--influx", metavar="FILE", default=influx_file, help="append the values in InfluxDB line protocol to FILE")
+    parser.add_argument("--json", metavar="FILE", default=json_stream, help="write one JSON document per frame to FILE ('-' for stdout)")
+    parser.add_argument("--log-file", default=log_file, help=f"log file, '-' for stderr (default {log_file})")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="log info (-v) or debug (-vv) messages")
+    args = parser.parse_args(argv)
+
+    if args.serial_port:
+        heat_pumps_config[0]["serial_port"] = args.serial_port
+    mqtt_host = args.mqtt_host
+    mqtt_port = args.mqtt_port
+    mqtt_username = args.mqtt_username
+    mqtt_password = args.mqtt_password
+    mqtt_v5 = args.mqtt_v5
+    replay_file = args.replay
+    replay_realtime = args.realtime
+    capture_file = args.capture
+    use_asyncio = args.asyncio
+    use_processes = args.processes
+    metrics_port = args.metrics_port
+    snapshot_socket = args.state_socket
+    sqlite_file = args.sqlite
+    influx_file = args.influx
+    json_stream = args.json
+    log_file = None if args.log_file == "-" else args.log_file
+    if args.verbose:
+        log_level = logging.DEBUG if args.verbose > 1 else logging.INFO
+
+    setup_logging()
     logger.info("Starting Nibe heat pump MQTT bridge")
-    run()
+    try:
+        setup()
+        run()
+    finally:
+        log_listener.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import math
+
+# Windowed aggregation of register values.
+#
+# Instead of every raw sample, an aggregated register is published as
+# <topic>/mean, <topic>/min and <topic>/max once per window (e.g. every 60 s),
+# which keeps the peaks but cuts the recorder traffic by the number of
+# samples per window. Accumulators are updated in O(1) per sample. Windows
+# are aligned to multiples of their length (wall clock), so 60 s windows end
+# on full minutes.
+
+
+class Accumulator:
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+
+class WindowAggregator:
+    # windows maps topic -> window length in seconds. add() returns True when
+    # the topic is aggregated (the raw sample should not be published),
+    # flush(now) returns [(topic, payload)] for every window that has ended.
+    def __init__(self, windows, precision=2):
+        self.windows = dict(windows)
+        self.precision = precision
+        self.accumulators = {topic: Accumulator() for topic in self.windows}
+        self.window_end = {}  # topic -> end of the running window
+
+    def add(self, topic, value, now):
+        acc = self.accumulators.get(topic)
+        if acc is None or type(value) is str:
+            return False
+        if topic not in self.window_end:
+            window = self.windows[topic]
+            self.window_end[topic] = (now // window + 1) * window
+        acc.add(value)
+        return True
+
+    def flush(self, now):
+        messages = []
+        for topic, end in self.window_end.items():
+            if now < end:
+                continue
+            acc = self.accumulators[topic]
+            if acc.count:
+                messages.append((f"{topic}/mean", round(acc.total / acc.count, self.precision)))
+                messages.append((f"{topic}/min", acc.min))
+                messages.append((f"{topic}/max", acc.max))
+                acc.reset()
+            window = self.windows[topic]
+            self.window_end[topic] = (now // window + 1) * window
+        return messages
@@ -0,0 +1,266 @@
+import argparse
+import json
+import sqlite3
+import sys
+
+import numpy as np
+
+from nibe_capture import read_capture
+from nibe_framing import HEADER_LENGTH
+from nibe_modes import load_operation_modes
+from nibe_registers import TABLE_SIZE
+
+# Offline analysis of the registers nobody has identified yet.
+#
+# Loads frame captures (nibe_capture.py) or the SQLite history
+# (nibe_sqlite.py) into one NumPy matrix, a row per frame and a column per
+# register (NaN where a frame did not have the register), and reports for
+# every register asked for:
+#
+#   distribution   min / max / mean / std and the most common values
+#   changes        changes per hour and the mean size of a change
+#   bits           share of the time each of the 16 bits is set and how often it toggles
+#   correlation    registers that move with it (Pearson r)
+#   modes          how much of it the operation mode (reg 28/29/30 tuple)
+#                  explains (eta squared) and its mean per mode
+#
+# Frames are not walked one by one: frames of the same length and the same
+# zero bytes (which is what decides the one / two byte values) are stacked
+# into a 2D byte array and every register is a column slice, so weeks of
+# captures take seconds. Needs numpy (pip install numpy), the bridge itself
+# does not.
+#
+#   python nibe_analyze.py nibe_frames.cap
+#   python nibe_analyze.py --sqlite nibe_history.db --registers 26,27
+unknown_registers = (2, 3, 26, 27, 37, 39, 41, 42)
+known_registers = (0, 1) + tuple(range(4, 26)) + (31, 32, 33, 34, 35, 36, 38, 40) + tuple(range(43, 51))
+MODE_REGISTERS = (28, 29, 30)
+
+
+def frame_layout(msg):
+    # The way iter_registers walks this register data: [(register offset,
+    # value offset, width)]. Only depends on the length and on which bytes
+    # are 00, so it is the same for every frame with the same zero bytes.
+    l = len(msg)
+    i = 4
+    layout = []
+    while i <= l:
+        if i != l and (msg[i] == 0x00 or i == (l - 1)):
+            layout.append((i - 3, i - 2, 2))
+            i += 4
+        else:
+            layout.append((i - 3, i - 2, 1))
+            i += 3
+    return layout
+
+
+def frames_to_matrix(frames):
+    # (rows, TABLE_SIZE) float matrix of the raw unsigned register values
+    values = np.full((len(frames), TABLE_SIZE), np.nan)
+    by_length = {}
+    for row, frame in enumerate(frames):
+        by_length.setdefault(len(frame), []).append(row)
+    for length, rows in by_length.items():
+        rows = np.array(rows)
+        block = np.frombuffer(b"".join(frames[row] for row in rows), dtype=np.uint8).reshape(len(rows), length)
+        payload = block[:, HEADER_LENGTH:-1]
+        # Group the frames by their zero bytes, each group is walked once
+        # (one bit per byte, a row viewed as one opaque value sorts fast)
+        zeros = np.ascontiguousarray(np.packbits(payload == 0, axis=1))
+        zeros = zeros.view(np.dtype((np.void, zeros.shape[1]))).reshape(-1)
+        _, first, group = np.unique(zeros, return_index=True, return_inverse=True)
+        group = group.reshape(-1)
+        order = np.argsort(group, kind="stable")
+        bounds = np.cumsum(np.bincount(group))
+        for g, start in enumerate(first):
+            members = order[bounds[g - 1] if g else 0:bounds[g]]
+            part = payload[members]
+            target = rows[members]
+            for reg_offset, offset, width in frame_layout(bytes(payload[start])):
+                column = part[:, offset].astype(np.float64)
+                if width == 2:
+                    column = column * 256 + part[:, offset + 1]
+                values[target, part[:, reg_offset]] = column
+    return values
+
+
+def load_captures(paths):
+    times = []
+    frames = []
+    for path in paths:
+        for timestamp, frame in read_capture(path):
+            times.append(timestamp)
+            frames.append(frame)
+    times = np.array(times)
+    order = np.argsort(times, kind="stable")
+    return times[order], frames_to_matrix([frames[i] for i in order])
+
+
+def load_sqlite(path, device=None):
+    # Decoded values from the history; operation modes are not stored there
+    db = sqlite3.connect(path)
+    query = "SELECT ts, register, value FROM samples"
+    if device:
+        rows = db.execute(query + " WHERE device = ? ORDER BY ts", (device,)).fetchall()
+    else:
+        rows = db.execute(query + " ORDER BY ts").fetchall()
+    db.close()
+    data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    times, row = np.unique(data[:, 0], return_inverse=True)
+    values = np.full((len(times), TABLE_SIZE), np.nan)
+    values[row, data[:, 1].astype(np.int64)] = data[:, 2]
+    return times, values
+
+
+def distribution(x, top=5):
+    unique, counts = np.unique(x, return_counts=True)
+    order = np.argsort(counts)[::-1][:top]
+    return {
+        "min": float(x.min()), "max": float(x.max()), "mean": float(x.mean()), "std": float(x.std()),
+        "distinct": int(len(unique)),
+        "common": [(float(unique[i]), int(counts[i])) for i in order],
+    }
+
+
+def changes(t, x):
+    steps = np.diff(x)
+    changed = steps != 0
+    hours = (t[-1] - t[0]) / 3600 if len(t) > 1 else 0
+    return {
+        "changes": int(changed.sum()),
+        "per_hour": float(changed.sum() / hours) if hours else None,
+        "mean_step": float(np.abs(steps[changed]).mean()) if changed.any() else 0.0,
+    }
+
+
+def bit_statistics(x):
+    bits = (x.astype(np.int64)[:, None] >> np.arange(16)) & 1
+    set_share = bits.mean(axis=0)
+    toggles = np.abs(np.diff(bits, axis=0)).sum(axis=0) if len(x) > 1 else np.zeros(16)
+    return {
+        "set_share": [round(float(s), 4) for s in set_share],
+        "toggles": [int(n) for n in toggles],
+    }
+
+
+def correlations(values, reg, candidates, top=5):
+    # Pearson r of the register against every candidate register, over the
+    # frames that have all of them
+    columns = [c for c in candidates if c != reg and not np.isnan(values[:, c]).all()]
+    data = values[:, [reg] + columns]
+    data = data[~np.isnan(data).any(axis=1)]
+    if len(data) < 3:
+        return []
+    std = data.std(axis=0)
+    if std[0] == 0:
+        return []
+    keep = std > 0
+    keep[0] = True
+    data = data[:, keep]
+    columns = [c for c, k in zip(columns, keep[1:]) if k]
+    z = (data - data.mean(axis=0)) / data.std(axis=0)
+    r = z[:, 1:].T @ z[:, 0] / len(z)
+    order = np.argsort(np.abs(r))[::-1][:top]
+    return [(columns[i], round(float(r[i]), 3)) for i in order]
+
+
+def mode_statistics(values, reg, mode_names, top=5):
+    # Share of the variance explained by the operation mode tuple (eta
+    # squared) and the mean value per mode
+    data = values[:, (reg,) + MODE_REGISTERS]
+    data = data[~np.isnan(data).any(axis=1)]
+    if len(data) < 3:
+        return None
+    x = data[:, 0]
+    key = (data[:, 1].astype(np.int64) << 32) | (data[:, 2].astype(np.int64) << 16) | data[:, 3].astype(np.int64)
+    modes, index = np.unique(key, return_inverse=True)
+    counts = np.bincount(index)
+    means = np.bincount(index, weights=x) / counts
+    total = ((x - x.mean()) ** 2).sum()
+    eta = float((counts * (means - x.mean()) ** 2).sum() / total) if total else None
+    order = np.argsort(counts)[::-1][:top]
+    per_mode = []
+    for i in order:
+        tuple_key = (int(modes[i] >> 32), int((modes[i] >> 16) & 0xFFFF), int(modes[i] & 0xFFFF))
+        name = mode_names.get(tuple_key, "unknown")
+        per_mode.append((f"{name} (0x{tuple_key[0]:04X}, 0x{tuple_key[1]:04X}, 0x{tuple_key[2]:04X})",
+                         int(counts[i]), round(float(means[i]), 3)))
+    return {"eta_squared": eta, "modes": int(len(modes)), "per_mode": per_mode}
+
+
+def analyze(times, values, registers, mode_names):
+    report = {}
+    # Every register once, the known ones first
+    candidates = tuple(dict.fromkeys(known_registers + unknown_registers))
+    for reg in registers:
+        valid = ~np.isnan(values[:, reg])
+        if not valid.any():
+            report[reg] = None
+            continue
+        x = values[valid, reg]
+        report[reg] = {
+            "samples": int(valid.sum()),
+            "distribution": distribution(x),
+            "changes": changes(times[valid], x),
+            "bits": bit_statistics(x),
+            "correlation": correlations(values, reg, candidates),
+            "modes": mode_statistics(values, reg, mode_names),
+        }
+    return report
+
+
+def print_report(report):
+    for reg, result in report.items():
+        print(f"Register {reg}")
+        if result is None:
+            print("  no samples\n")
+            continue
+        dist = result["distribution"]
+        print(f"  samples {result['samples']}, min {dist['min']:g}, max {dist['max']:g}, "
+              f"mean {dist['mean']:.2f}, std {dist['std']:.2f}, {dist['distinct']} distinct values")
+        print("  most common: " + ", ".join(f"{value:g} ({count})" for value, count in dist["common"]))
+        ch = result["changes"]
+        per_hour = "-" if ch["per_hour"] is None else f"{ch['per_hour']:.1f}"
+        print(f"  changes: {ch['changes']} ({per_hour} per hour), mean step {ch['mean_step']:.2f}")
+        bits = result["bits"]
+        active = [f"b{bit} {share:.0%}/{toggles}" for bit, (share, toggles)
+                  in enumerate(zip(bits["set_share"], bits["toggles"])) if share]
+        print("  bits set (share/toggles): " + (", ".join(active) or "none"))
+        if result["correlation"]:
+            print("  correlates with: " + ", ".join(f"reg {other} r={r:+.3f}" for other, r in result["correlation"]))
+        modes = result["modes"]
+        if modes and modes["eta_squared"] is not None:
+            print(f"  operation mode explains {modes['eta_squared']:.0%} of the variance ({modes['modes']} mode tuples)")
+            for name, count, mean in modes["per_mode"]:
+                print(f"    {name}: mean {mean:g} over {count} frames")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statistics of the unidentified registers in captures or the SQLite history")
+    parser.add_argument("captures", nargs="*", help="frame capture files (nibe_capture.py)")
+    parser.add_argument("--sqlite", metavar="DATABASE", help="SQLite history instead of captures (no operation modes)")
+    parser.add_argument("--device", help="heat pump (topic prefix) in the SQLite history")
+    parser.add_argument("--registers", help=f"comma separated registers (default {','.join(map(str, unknown_registers))})")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        times, values = load_sqlite(args.sqlite, args.device)
+    elif args.captures:
+        times, values = load_captures(args.captures)
+    else:
+        parser.error("give capture files or --sqlite")
+    if not len(times):
+        sys.exit("No frames")
+    registers = [int(reg) for reg in args.registers.split(",")] if args.registers else unknown_registers
+    report = analyze(times, values, registers, load_operation_modes()[0])
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{len(times)} frames, {(times[-1] - times[0]) / 3600:.1f} hours\n")
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from nibe_framing import FrameParser, FrameStats
+
+logger = logging.getLogger('NIBE')
+
+# asyncio runtime for the bridge.
+#
+# The serial side is a reader callback on the event loop that does nothing
+# but framing and ACKs: it reads what the port has waiting, feeds the parser
+# (which writes the ACKs) and puts each validated frame on an asyncio.Queue.
+# A separate publisher task takes the frames off the queue and hands them to
+# handle_frame on a single worker thread, so decoding, logging and
+# mqtt_client.publish never hold up the event loop and the next ACK.
+#
+# Needs a serial port with fileno() (pyserial on Linux / macOS).
+
+
+async def publish_frames(queue, handle_frame, stats):
+    loop = asyncio.get_running_loop()
+    # One worker keeps the frames in order
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="nibe-publish") as executor:
+        while True:
+            frame = await queue.get()
+            stats.queue_depth = queue.qsize()
+            try:
+                await loop.run_in_executor(executor, handle_frame, frame)
+            except Exception as e:
+                logger.warning("Error in Nibe data processing: %s", e)
+            finally:
+                queue.task_done()
+
+
+async def read_frames(ser, queue, idle_timeout=0.2, stats=None):
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    idle_timer = None
+
+    def on_frame(frame):
+        try:
+            queue.put_nowait(bytes(frame))
+        except asyncio.QueueFull:
+            parser.stats.frames_dropped += 1
+            logger.warning("Publish queue full, dropped frame (%s so far)", parser.stats.frames_dropped)
+        parser.stats.queue_depth = queue.qsize()
+
+    parser = FrameParser(ser.write, on_frame, stats)
+
+    def on_idle():
+        nonlocal idle_timer
+        idle_timer = None
+        parser.idle()
+
+    def on_readable():
+        nonlocal idle_timer
+        try:
+            data = ser.read(ser.in_waiting)
+            if data:
+                parser.feed(data)
+        except Exception as e:
+            if not stopped.done():
+                stopped.set_exception(e)
+            return
+        # A frame that stalls for idle_timeout is given up
+        if idle_timer is not None:
+            idle_timer.cancel()
+        idle_timer = loop.call_later(idle_timeout, on_idle)
+
+    loop.add_reader(ser.fileno(), on_readable)
+    try:
+        await stopped
+    finally:
+        loop.remove_reader(ser.fileno())
+        if idle_timer is not None:
+            idle_timer.cancel()
+
+
+async def run_bridge(ser, handle_frame, idle_timeout=0.2, queue_size=100, stats=None):
+    if stats is None:
+        stats = FrameStats()
+    queue = asyncio.Queue(queue_size)
+    publisher = asyncio.create_task(publish_frames(queue, handle_frame, stats))
+    try:
+        await read_frames(ser, queue, idle_timeout, stats)
+    finally:
+        publisher.cancel()
@@ -0,0 +1,68 @@
+import struct
+import time
+
+from nibe_framing import PREAMBLE, FrameParser
+
+# Raw frame capture files.
+#
+# A capture starts with the magic below, followed by one record per frame:
+#
+#   timestamp (float64, seconds since the epoch) | length (uint16) | frame
+#
+# all little endian. The frame is stored as received, header and checksum
+# included, so a capture can be fed back through the parser unchanged.
+CAPTURE_MAGIC = b"NIBECAP1"
+record_header = struct.Struct("<dH")
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.frames = 0
+
+    def write(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(record_header.pack(timestamp, len(frame)))
+        self.file.write(frame)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    # Yields (timestamp, frame bytes) for every record of a capture file
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a frame capture")
+        while True:
+            head = f.read(record_header.size)
+            if len(head) < record_header.size:
+                return
+            timestamp, length = record_header.unpack(head)
+            frame = f.read(length)
+            if len(frame) < length:
+                return  # capture cut short, e.g. the bridge was killed
+            yield timestamp, frame
+
+
+def replay_capture(path, on_frame, realtime=False, speed=1.0, stats=None):
+    # Feeds a capture through a FrameParser, exactly like the serial port
+    # would, so framing, checksum and decoding all see the recorded traffic.
+    # With realtime the original spacing of the frames is kept (divided by
+    # speed), otherwise the frames are replayed as fast as possible.
+    # Returns the parser, its stats tell what was replayed.
+    parser = FrameParser(lambda ack: None, on_frame, stats)
+    first = None
+    start = time.monotonic()
+    for timestamp, frame in read_capture(path):
+        if realtime:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        parser.feed(PREAMBLE + frame)
+    return parser
@@ -0,0 +1,141 @@
+from collections import deque
+
+# Values derived from the registers on the bridge.
+#
+# Each update is O(1) (amortized, the windows are deques that are trimmed
+# from the left), so nothing is recomputed from the history:
+#
+#   delta_t_c                    flow (reg 6) - return (reg 7) temperature
+#   compressor_duty_percent      share of the window the compressor ran (reg 10 > 0)
+#   compressor_on_minutes        length of the last completed on cycle
+#   compressor_off_minutes       length of the last completed off cycle
+#   compressor_starts_per_hour   increase of the start counter (reg 25) over the window
+#   defrosts_per_day             defrosts started in the last 24 hours (operation mode, reg 30)
+#   defrost_interval_minutes     time between the last two defrost starts
+#
+# update(reg, value, now) returns [(name, value)] of the derived values the
+# register changed. now is time.time(). Values that depend on several
+# registers of the same frame (delta_t_c) are only returned by end_frame(),
+# once all of them are in, never half old, half new.
+FLOW = 6
+RETURN = 7
+COMPRESSOR_FREQ = 10
+COMPRESSOR_STARTS = 25
+OPERATION_MODE = 30
+
+derived_registers = frozenset((FLOW, RETURN, COMPRESSOR_FREQ, COMPRESSOR_STARTS, OPERATION_MODE))
+derived_values = (
+    "delta_t_c", "compressor_duty_percent", "compressor_on_minutes", "compressor_off_minutes",
+    "compressor_starts_per_hour", "defrosts_per_day", "defrost_interval_minutes",
+)
+
+
+class DerivedMetrics:
+    def __init__(self, window=3600, defrost_modes=("Sulatus",), defrost_window=86400):
+        self.window = window
+        self.defrost_modes = frozenset(defrost_modes)
+        self.defrost_window = defrost_window
+        self.flow = None
+        self.ret = None
+        self.temperatures_changed = False
+        # Compressor cycles
+        self.running = None
+        self.changed_at = None      # start of the current on or off period
+        self.first_seen = None
+        self.on_periods = deque()   # completed (start, end) on periods in the window
+        self.on_total = 0.0         # sum of their full lengths
+        # Start counter samples (timestamp, count), oldest one at or before the window start
+        self.starts = deque()
+        # Defrost starts in the defrost window
+        self.in_defrost = False
+        self.defrosts = deque()
+
+    def update(self, reg, value, now):
+        if reg == FLOW:
+            self.flow = value
+            self.temperatures_changed = True
+            return []
+        if reg == RETURN:
+            self.ret = value
+            self.temperatures_changed = True
+            return []
+        if reg == COMPRESSOR_FREQ:
+            return self._compressor(value > 0, now)
+        if reg == COMPRESSOR_STARTS:
+            return self._starts(value, now)
+        if reg == OPERATION_MODE:
+            return self._defrost(value in self.defrost_modes, now)
+        return []
+
+    def end_frame(self):
+        # Derived values of the whole frame, called after its last register
+        if not self.temperatures_changed:
+            return []
+        self.temperatures_changed = False
+        if self.flow is None or self.ret is None:
+            return []
+        return [("delta_t_c", round(self.flow - self.ret, 1))]
+
+    def _compressor(self, running, now):
+        result = []
+        if self.running is None:
+            self.first_seen = now
+        elif running != self.running:
+            minutes = round((now - self.changed_at) / 60, 1)
+            if self.running:
+                self.on_periods.append((self.changed_at, now))
+                self.on_total += now - self.changed_at
+                result.append(("compressor_on_minutes", minutes))
+            else:
+                result.append(("compressor_off_minutes", minutes))
+        if running != self.running:
+            self.running = running
+            self.changed_at = now
+
+        # On time in the window: completed periods (the oldest one clipped at
+        # the window start) plus the running period
+        start = now - self.window
+        periods = self.on_periods
+        while periods and periods[0][1] <= start:
+            first_start, first_end = periods.popleft()
+            self.on_total -= first_end - first_start
+        on_time = self.on_total
+        if periods and periods[0][0] < start:
+            on_time -= start - periods[0][0]
+        if running:
+            on_time += now - max(self.changed_at, start)
+        elapsed = min(now - self.first_seen, self.window)
+        if elapsed > 0:
+            result.append(("compressor_duty_percent", round(100 * on_time / elapsed, 1)))
+        return result
+
+    def _starts(self, count, now):
+        starts = self.starts
+        if starts and count < starts[-1][1]:
+            # Counter was reset
+            starts.clear()
+        if not starts or count != starts[-1][1]:
+            starts.append((now, count))
+        start = now - self.window
+        while len(starts) > 1 and starts[1][0] <= start:
+            starts.popleft()
+        # The counter did not move between the oldest sample and the window start
+        first_time, first_count = starts[0]
+        elapsed = now - max(first_time, start)
+        # Less than a tenth of the window gives no meaningful rate yet
+        if elapsed < self.window / 10:
+            return []
+        return [("compressor_starts_per_hour", round((count - first_count) * 3600 / elapsed, 1))]
+
+    def _defrost(self, defrost, now):
+        result = []
+        if defrost and not self.in_defrost:
+            if self.defrosts:
+                result.append(("defrost_interval_minutes", round((now - self.defrosts[-1]) / 60, 1)))
+            self.defrosts.append(now)
+        self.in_defrost = defrost
+        start = now - self.defrost_window
+        while self.defrosts and self.defrosts[0] <= start:
+            self.defrosts.popleft()
+        result.append(("defrosts_per_day", len(self.defrosts)))
+        return result
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('NIBE')
+
+# Home Assistant discovery publishing.
+#
+# The discovery configs are serialized once to JSON bytes. A hash of every
+# config published as retained message is kept in a small state file, so a
+# restart only republishes the configs that changed since the retained copy
+# on the broker, instead of all of them (each republished config makes Home
+# Assistant reload the entity). Configs that are no longer generated are
+# removed with an empty retained message.
+#
+# The state file only says what was sent, not what the broker still has. A
+# broker restarted without persistence, or a new one, has lost the retained
+# configs; check_broker() subscribes to the config topics and takes the
+# hashes from the retained copies the broker sends back instead, so what is
+# missing or different gets published again. Call it on every connect that
+# does not continue an earlier session, from a thread other than the
+# client's network thread (the retained copies arrive on that one).
+default_state_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".discovery_state.json")
+
+
+def encode_payload(payload):
+    # Stable JSON bytes, the same config always gives the same hash
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def payload_hash(payload):
+    return hashlib.sha1(payload).hexdigest()
+
+
+class DiscoveryPublisher:
+    def __init__(self, client, state_file=default_state_file):
+        self.client = client
+        self.state_file = state_file
+        self.published = {}  # discovery topic -> hash of the retained config
+        self.unchanged = 0
+        # check_broker() and publish() run one at a time, a reconnect can
+        # start the next announce while the last one still waits for the broker
+        self.lock = threading.Lock()
+        if state_file:
+            try:
+                with open(state_file, encoding="utf-8") as f:
+                    self.published = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def check_broker(self, topics, timeout=5, settle=0.5):
+        # Replaces the recorded hashes of topics with those of the retained
+        # copies on the broker. Waits for the SUBACK and then settle seconds
+        # for the retained messages. Returns False when the broker did not
+        # answer in time, the recorded hashes are kept then.
+        with self.lock:
+            return self._check_broker(topics, timeout, settle)
+
+    def _check_broker(self, topics, timeout, settle):
+        topics = sorted(set(topics) | set(self.published))
+        if not topics:
+            return True
+        retained = {}
+        acked = set()
+        answered = threading.Condition()
+
+        def on_message(client, userdata, message):
+            if message.retain:
+                retained[message.topic] = payload_hash(message.payload) if message.payload else None
+
+        def on_subscribe(client, userdata, mid, *args):
+            # May come before subscribe() has returned the mid
+            with answered:
+                acked.add(mid)
+                answered.notify_all()
+
+        self.client.on_subscribe = on_subscribe
+        for topic in topics:
+            self.client.message_callback_add(topic, on_message)
+        try:
+            rc, mid = self.client.subscribe([(topic, 0) for topic in topics])
+            with answered:
+                ok = rc == 0 and answered.wait_for(lambda: mid in acked, timeout)
+            if not ok:
+                logger.warning("Broker did not answer the discovery subscription, keeping the recorded state")
+                return False
+            time.sleep(settle)
+        finally:
+            self.client.unsubscribe(topics)
+            for topic in topics:
+                self.client.message_callback_remove(topic)
+            self.client.on_subscribe = None
+        self.published = {topic: digest for topic, digest in retained.items() if digest is not None}
+        return True
+
+    def publish(self, messages):
+        # messages is [(topic, payload bytes)] of every config of the bridge,
+        # returns the number of configs published or removed
+        with self.lock:
+            return self._publish(messages)
+
+    def _publish(self, messages):
+        count = 0
+        current = set()
+        for topic, payload in messages:
+            current.add(topic)
+            digest = payload_hash(payload)
+            if self.published.get(topic) == digest:
+                self.unchanged += 1
+                continue
+            if self.client.publish(topic, payload, qos=0, retain=True).rc == 0:
+                self.published[topic] = digest
+            count += 1
+        for topic in [topic for topic in self.published if topic not in current]:
+            if self.client.publish(topic, b"", qos=0, retain=True).rc == 0:
+                del self.published[topic]
+            count += 1
+        if count:
+            self.save()
+        return count
+
+    def save(self):
+        if not self.state_file:
+            return
+        try:
+            tmp = f"{self.state_file}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.published, f, separators=(",", ":"))
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            logger.warning(f"Could not write discovery state {self.state_file}: {e}")
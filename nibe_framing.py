@@ -0,0 +1,193 @@
+import logging
+import time
+
+logger = logging.getLogger('NIBE')
+
+# The heat pump addresses the logger with 03 00 14, the logger answers with
+# an ACK (0x06), then the pump sends the frame:
+#
+#   header (3 bytes) | length | data (length bytes) | xor checksum
+#
+# which is ACKed again once it has been received.
+PREAMBLE = b"\x03\x00\x14"
+ACK = b"\x06"
+HEADER_LENGTH = 4
+
+# Parser states
+WAIT_PREAMBLE = 0
+WAIT_HEADER = 1
+WAIT_BODY = 2
+
+
+def checksum_ok(frame):
+    crc = 0
+    for i in frame[:-1]:
+        crc ^= i
+    return crc == frame[-1]
+
+
+def frame_payload(frame):
+    # Register data of a frame, without header, length and checksum
+    return frame[HEADER_LENGTH:-1]
+
+
+def iter_registers(msg):
+    # Walks the register data of a frame: 00 <reg> <value, one or two bytes>.
+    # A value is two bytes when it is followed by the next 00 separator or
+    # when it ends the frame. Yields (register, raw unsigned value).
+    l = len(msg)
+    i = 4
+    while i <= l:
+        reg = msg[i - 3]
+        if i != l and (msg[i] == 0x00 or i == (l - 1)):
+            yield reg, (msg[i - 2] << 8) | msg[i - 1]
+            i += 4
+        else:
+            yield reg, msg[i - 2]
+            i += 3
+
+
+class FrameStats:
+    # Counters of a parser, can be shared by several parsers (restarts,
+    # replay) so the totals survive them. ack_latency is an optional
+    # histogram (anything with observe()) for the time from the bytes being
+    # fed to the ACK being written. queue_depth / frames_dropped are kept
+    # by runtimes that queue frames (nibe_async.py).
+    def __init__(self, ack_latency=None):
+        self.frames = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+        self.handler_errors = 0  # exceptions raised by on_frame
+        self.bytes_discarded = 0
+        self.ack_latency = ack_latency
+        self.queue_depth = 0
+        self.frames_dropped = 0
+
+
+class FrameParser:
+    # Incremental parser for the logger protocol.
+    #
+    # feed() takes whatever the serial port had waiting, finds the preamble
+    # with bytearray.find instead of byte by byte reads, sends the ACKs through
+    # the ack callable as soon as the preamble / a whole frame is in the
+    # buffer and hands every frame with a valid checksum to on_frame as a
+    # memoryview into the buffer. The view is released when on_frame returns,
+    # copy it (bytes(frame)) if it is needed later. An exception raised by
+    # on_frame is logged and counted (stats.handler_errors), the frame is
+    # consumed all the same.
+    #
+    # idle() is called when a read returned nothing. A frame that stalls half
+    # way (line noise ate the length byte, the pump restarted) is given up
+    # and the buffered bytes are searched for the next preamble right away.
+    def __init__(self, ack, on_frame, stats=None):
+        self.ack = ack
+        self.on_frame = on_frame
+        self.stats = stats if stats is not None else FrameStats()
+        self.buffer = bytearray()
+        self.state = WAIT_PREAMBLE
+        self.frame_length = 0
+        self.fed_at = 0.0
+
+    def reset(self):
+        self.buffer.clear()
+        self.state = WAIT_PREAMBLE
+
+    def feed(self, data):
+        self.fed_at = time.perf_counter()
+        self.buffer += data
+        self._parse()
+
+    def _ack(self):
+        self.ack(ACK)
+        if self.stats.ack_latency is not None:
+            self.stats.ack_latency.observe(time.perf_counter() - self.fed_at)
+
+    def idle(self):
+        if self.state != WAIT_PREAMBLE:
+            logger.debug("Frame stalled, resyncing")
+            self.state = WAIT_PREAMBLE
+            self.stats.resyncs += 1
+            self.fed_at = time.perf_counter()
+            self._parse()
+
+    def _parse(self):
+        stats = self.stats
+        buf = self.buffer
+        end = len(buf)
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while True:
+                if self.state == WAIT_PREAMBLE:
+                    idx = buf.find(PREAMBLE, pos)
+                    if idx < 0:
+                        # Keep the tail in case a preamble is split between reads
+                        keep = max(pos, end - len(PREAMBLE) + 1)
+                        stats.bytes_discarded += keep - pos
+                        pos = keep
+                        break
+                    if idx != pos:
+                        stats.bytes_discarded += idx - pos
+                    pos = idx + len(PREAMBLE)
+                    self._ack()
+                    self.state = WAIT_HEADER
+                elif self.state == WAIT_HEADER:
+                    if end - pos < HEADER_LENGTH:
+                        break
+                    if buf[pos] == 0x03:
+                        # The pump started over, look for the preamble from here
+                        self.state = WAIT_PREAMBLE
+                        continue
+                    self.frame_length = HEADER_LENGTH + buf[pos + 3] + 1
+                    self.state = WAIT_BODY
+                else:
+                    if end - pos < self.frame_length:
+                        break
+                    self._ack()
+                    self.state = WAIT_PREAMBLE
+                    frame = view[pos:pos + self.frame_length]
+                    pos += self.frame_length
+                    try:
+                        if checksum_ok(frame):
+                            stats.frames += 1
+                            self.on_frame(frame)
+                        else:
+                            stats.crc_errors += 1
+                            logger.warning("Frame CRC error")
+                    except Exception:
+                        # The frame has been ACKed and is consumed, an error
+                        # of the handler must not make it come round again
+                        stats.handler_errors += 1
+                        logger.exception("Error handling a frame")
+                    finally:
+                        frame.release()
+        finally:
+            view.release()
+            if pos:
+                try:
+                    del buf[:pos]
+                except BufferError:
+                    # Something still holds a view of the buffer (a slice
+                    # kept by a traceback that is being logged), carry on
+                    # with a copy of the rest
+                    self.buffer = bytearray(buf[pos:])
+
+
+def build_frame(registers, header=b"\xc0\x00\x59"):
+    # Builds a logger frame from (register, raw value, width) tuples, the
+    # inverse of iter_registers. The data ends with a 00 byte so the last
+    # register keeps its width when the frame is walked again.
+    data = bytearray()
+    for reg, value, width in registers:
+        data.append(0x00)
+        data.append(reg)
+        data += value.to_bytes(width, 'big')
+    data.append(0x00)
+    frame = bytearray(header)
+    frame.append(len(data))
+    frame += data
+    crc = 0
+    for i in frame:
+        crc ^= i
+    frame.append(crc)
+    return bytes(frame)
@@ -0,0 +1,128 @@
+import time
+from array import array
+from bisect import bisect_left
+
+# Recent history of every register, kept in memory.
+#
+# Each register gets a fixed size ring buffer of (timestamp, value) samples
+# stored in two array('d'), so there are no Python objects per sample and
+# memory stays the same after months of uptime: 16 bytes per sample, e.g.
+# 3600 samples (about two hours at one frame every two seconds) take 56 KiB
+# per register. Timestamps are time.time() and only ever grow, so window
+# queries are binary searches.
+
+
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0
+        self.next = 0  # slot the next sample goes to
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        i = self.next
+        self.times[i] = timestamp
+        self.values[i] = value
+        self.next = i + 1 if i + 1 < self.size else 0
+        if self.count < self.size:
+            self.count += 1
+
+    def _segments(self):
+        # (start, end) index ranges of the stored samples, oldest first
+        if self.count < self.size:
+            return ((0, self.count),)
+        return ((self.next, self.size), (0, self.next))
+
+    def _since(self, since):
+        # Index ranges of the samples with timestamp >= since
+        ranges = []
+        for start, end in self._segments():
+            if since is not None:
+                start = bisect_left(self.times, since, start, end)
+            if start < end:
+                ranges.append((start, end))
+        return ranges
+
+    def last(self):
+        # Latest (timestamp, value), None when empty
+        if not self.count:
+            return None
+        i = self.next - 1 if self.next else self.size - 1
+        return self.times[i], self.values[i]
+
+    def samples(self, since=None):
+        # [(timestamp, value)] since the given time, oldest first
+        result = []
+        for start, end in self._since(since):
+            result.extend(zip(self.times[start:end], self.values[start:end]))
+        return result
+
+    def last_minutes(self, minutes, now=None):
+        if now is None:
+            now = time.time()
+        return self.samples(now - minutes * 60)
+
+    def stats(self, since=None):
+        # (min, max, mean, count) of the samples since the given time
+        lo = hi = None
+        total = 0.0
+        count = 0
+        for start, end in self._since(since):
+            values = self.values[start:end]
+            seg_lo = min(values)
+            seg_hi = max(values)
+            lo = seg_lo if lo is None or seg_lo < lo else lo
+            hi = seg_hi if hi is None or seg_hi > hi else hi
+            total += sum(values)
+            count += end - start
+        if not count:
+            return None
+        return lo, hi, total / count, count
+
+    def rate(self, since=None):
+        # Rate of change per second (least squares slope) since the given
+        # time, None with fewer than two samples
+        ranges = self._since(since)
+        n = sum(end - start for start, end in ranges)
+        if n < 2:
+            return None
+        t0 = self.times[ranges[0][0]]
+        sum_t = sum_v = sum_tt = sum_tv = 0.0
+        for start, end in ranges:
+            for t, v in zip(self.times[start:end], self.values[start:end]):
+                t -= t0
+                sum_t += t
+                sum_v += v
+                sum_tt += t * t
+                sum_tv += t * v
+        denominator = n * sum_tt - sum_t * sum_t
+        if not denominator:
+            return None
+        return (n * sum_tv - sum_t * sum_v) / denominator
+
+
+class RegisterHistory:
+    # One RingBuffer per register number, allocated on the first numeric
+    # sample. Text values (operation mode, heating status) are not kept.
+    def __init__(self, size=3600):
+        self.size = size
+        self.buffers = [None] * 256
+
+    def record(self, reg, value, timestamp):
+        if type(value) is str:
+            return
+        buffer = self.buffers[reg]
+        if buffer is None:
+            buffer = self.buffers[reg] = RingBuffer(self.size)
+        buffer.append(timestamp, value)
+
+    def get(self, reg):
+        # RingBuffer of the register, None when nothing has been recorded
+        return self.buffers[reg]
+
+    def registers(self):
+        return [reg for reg, buffer in enumerate(self.buffers) if buffer is not None]
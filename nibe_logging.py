@@ -0,0 +1,106 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Logging that never blocks the serial side.
+#
+# Loggers only put records on an in-memory queue (QueueHandler), a listener
+# thread formats them and writes them to a size rotated file or stderr.
+# Records are passed on unformatted, so the message is only built by the
+# listener and only for records that pass the level; callers on the hot
+# path log with %-style arguments ("Published %s to %s", value, topic)
+# instead of f-strings.
+#
+# Warnings and errors that repeat (same message, same arguments) are logged
+# once per repeat_interval seconds, the next one that gets through says how
+# many were suppressed in between.
+log_format = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=60, max_keys=1024):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.seen = {}  # key -> [next time it may be logged, suppressed count]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or not self.interval:
+            return True
+        key = (record.levelno, record.msg, tuple(map(str, record.args)) if isinstance(record.args, tuple) else None)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            if len(self.seen) >= self.max_keys and entry is None:
+                self.seen.clear()
+            self.seen[key] = [now + self.interval, 0]
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The standard QueueHandler formats the message before queueing it, in
+    # the thread that logs. Within one process the record can be queued as
+    # it is and formatted by the listener.
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # Tracebacks can not wait, the frames are gone by then
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+def setup_logging(log_file=None, level=logging.WARNING, max_bytes=1024 * 1024, backups=3, repeat_interval=60):
+    # Routes the root logger through the queue, returns the listener (stop()
+    # it to write what is still queued)
+    if log_file:
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(log_format))
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(repeat_interval))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Processes started with "spawn" (nibe_shm.py) have no handlers of their
+# own. Their records go through a multiprocessing queue to the parent, which
+# hands them to its handlers, so they end up in the same (rotated) log file
+# and pass the same rate limit.
+
+class _ForwardHandler:
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def setup_process_logging(records, level=logging.WARNING):
+    # In the child: everything goes to records, a multiprocessing queue.
+    # The standard QueueHandler formats the message before it is pickled.
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+
+
+def forward_process_logs(records):
+    # In the parent: passes the records of the children on to the own
+    # handlers, returns the listener (stop() it when the children are gone)
+    listener = logging.handlers.QueueListener(records, _ForwardHandler())
+    listener.start()
+    return listener
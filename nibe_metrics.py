@@ -0,0 +1,147 @@
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('NIBE')
+
+# Minimal Prometheus instrumentation for the bridge, no client library
+# needed. Counters and gauges either hold a value or read it from a
+# function when scraped (for counters kept elsewhere, e.g. FrameStats), a
+# function may also return {device: value} for one sample per heat pump
+# (or per other label, e.g. {sink: value} with label="sink").
+# Histograms count observations into fixed buckets. Everything is served
+# in the Prometheus text format by start_metrics_server().
+
+# Seconds, from 10 µs to 1 s
+default_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, func=None, label="device"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        value = self.func() if self.func else self.value
+        if isinstance(value, dict):
+            # Function returned one value per device
+            for device, device_value in value.items():
+                yield f'{self.name}{{{self.label}="{device}"}}', device_value
+        else:
+            yield self.name, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total):
+        # Adds the bucket counts and sum of observations made elsewhere with
+        # the same buckets (e.g. in a reader process)
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+        self.count += sum(counts)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, func=None, label="device"):
+        return self._add(Counter(name, help, func, label))
+
+    def gauge(self, name, help, func=None, label="device"):
+        return self._add(Gauge(name, help, func, label))
+
+    def histogram(self, name, help, buckets=default_buckets):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {_format(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def start_metrics_server(metrics, port, host="127.0.0.1", state=None):
+    # Serves /metrics on a daemon thread, returns the server. state is an
+    # optional callable returning the JSON bytes served on /state.
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/state" and state is not None:
+                body = state()
+                content_type = "application/json"
+            elif path in ("/", "/metrics"):
+                body = metrics.render().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep scrapes out of the log
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="nibe-metrics", daemon=True).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger('NIBE')
+
+# Operation mode from registers 28, 29 and 30.
+#
+# The known combinations are loaded from operation_modes.json into a dict
+# keyed on the (reg28, reg29, reg30) tuple. Combinations that are not in the
+# table go through the "bits" rules of the same file: each rule lists
+# [mask, value] pairs per register, the first rule whose registers all match
+# (reg & mask == value) gives the mode. New modes only need an entry in the
+# data file. Numbers may be written as hex ("0x4409") or decimal strings.
+default_modes_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "operation_modes.json")
+
+mode_registers = ("reg28", "reg29", "reg30")
+
+
+def load_operation_modes(path=default_modes_file):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    modes = {}
+    for row in data.get("modes", []):
+        key = tuple(int(row[reg], 0) for reg in mode_registers)
+        modes[key] = row["mode"]
+    bits = []
+    for row in data.get("bits", []):
+        # One (mask, value) per register, (0, 0) matches anything
+        rule = tuple(
+            (int(row[reg][0], 0), int(row[reg][1], 0)) if reg in row else (0, 0)
+            for reg in mode_registers
+        )
+        bits.append((rule, row["mode"]))
+    return modes, bits
+
+
+class OperationModeDecoder:
+    # Keeps the latest register 28 and 29 values of one heat pump, register
+    # 30 comes last in a frame and completes the tuple.
+    def __init__(self, modes, bits=()):
+        self.modes = modes
+        self.bits = list(bits)
+        self.reg28 = None
+        self.reg29 = None
+        self.reg30 = None
+        self.mode = None
+        self.unknown = set()  # combinations already logged
+
+    @classmethod
+    def from_file(cls, path=default_modes_file):
+        return cls(*load_operation_modes(path))
+
+    def decode_reg28(self, value):
+        self.reg28 = value
+        return None
+
+    def decode_reg29(self, value):
+        self.reg29 = value
+        return None
+
+    def decode_reg30(self, value):
+        self.reg30 = value
+        self.mode = self.lookup(self.reg28, self.reg29, value)
+        return self.mode
+
+    def lookup(self, reg28, reg29, reg30):
+        key = (reg28, reg29, reg30)
+        mode = self.modes.get(key)
+        if mode is not None:
+            return mode
+        if reg28 is not None and reg29 is not None:
+            for rule, bits_mode in self.bits:
+                if all(value & mask == expected for value, (mask, expected) in zip(key, rule)):
+                    mode = bits_mode
+                    break
+        # Log every unknown combination once, not on every frame
+        if key not in self.unknown:
+            if len(self.unknown) >= 1024:
+                self.unknown.clear()
+            self.unknown.add(key)
+            if mode is not None:
+                logger.info("Operation mode %s from register bits: reg28=%s, reg29=%s, reg30=%s", mode, reg28, reg29, reg30)
+            else:
+                logger.warning("Unknown combination of register values: reg28=%s, reg29=%s, reg30=%s", reg28, reg29, reg30)
+        if mode is None:
+            mode = f"Unknown mode: reg28={reg28}, reg29={reg29}, reg30={reg30}"
+        return mode
@@ -0,0 +1,68 @@
+import threading
+from collections import namedtuple
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+# MQTT v5 publishing: topic aliases and message expiry.
+#
+# With topic aliases a topic is sent in full once per connection together
+# with a small number, after that the number alone (2 bytes instead of e.g.
+# the 31 of nibe/domestic_hot_water_top_temp). The broker says in CONNACK
+# how many aliases it keeps per connection (TopicAliasMaximum, mosquitto
+# defaults to 10), they are handed out to the first QoS 0 topics published
+# and start over on every connect.
+#
+# Only QoS 0 messages go out with the alias alone. paho sends a QoS 1/2
+# message again after a reconnect, when the new connection does not know the
+# alias any more, so those always carry the full topic.
+#
+# TopicAliasPublisher stands in for the client (publish(topic, payload, qos,
+# retain)) in the outbox, and adds the message expiry of the topic.
+
+# How a value is published: QoS, retained or not, and seconds after which the
+# broker drops the message (None never, only with MQTT v5)
+PublishProfile = namedtuple("PublishProfile", "qos retain expiry")
+
+
+class TopicAliasPublisher:
+    def __init__(self, client, expiries=None):
+        self.client = client
+        self.expiries = dict(expiries or {})  # topic -> message expiry in seconds
+        self.aliases = {}  # topic -> alias given out on this connection
+        self.known = set()  # topics the broker has seen together with their alias
+        self.maximum = 0
+        self.lock = threading.Lock()
+        # Statistics
+        self.aliased = 0
+
+    def connected(self, properties=None):
+        # Called from on_connect with the CONNACK properties, aliases of an
+        # earlier connection are not valid any more
+        with self.lock:
+            self.aliases = {}
+            self.known = set()
+            self.maximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        expiry = self.expiries.get(topic)
+        with self.lock:
+            alias = self.aliases.get(topic)
+            if alias is None and qos == 0 and len(self.aliases) < self.maximum:
+                alias = len(self.aliases) + 1
+                self.aliases[topic] = alias
+            if alias is None and not expiry:
+                return self.client.publish(topic, payload, qos=qos, retain=retain)
+            properties = Properties(PacketTypes.PUBLISH)
+            if expiry:
+                properties.MessageExpiryInterval = expiry
+            if alias is None:
+                return self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            properties.TopicAlias = alias
+            if qos == 0 and topic in self.known:
+                self.aliased += 1
+                return self.client.publish("", payload, qos=qos, retain=retain, properties=properties)
+            info = self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            if info.rc == 0:
+                self.known.add(topic)
+            return info
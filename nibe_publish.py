@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ChangeFilter:
+    # Last published value per topic, so a value is only published again when
+    # it has moved at least its deadband away from what was published last,
+    # or when the heartbeat interval for the topic has run out (keeps Home
+    # Assistant from marking the sensor stale and covers lost messages).
+    #
+    # deadbands maps topic -> deadband, topics without one (and all values
+    # that are not numbers) are published on any change.
+    def __init__(self, deadbands=None, heartbeat=300):
+        self.deadbands = dict(deadbands or {})
+        self.heartbeat = heartbeat
+        self.last = {}  # topic -> (value, time published)
+        # Statistics
+        self.passed = 0
+        self.suppressed = 0
+
+    def changed(self, topic, value, now=None):
+        if now is None:
+            now = time.monotonic()
+        last = self.last.get(topic)
+        if last is not None and now - last[1] < self.heartbeat:
+            deadband = self.deadbands.get(topic)
+            if deadband:
+                # Small tolerance so 21.5 - 21.3 counts as a 0.2 step
+                unchanged = abs(value - last[0]) + 1e-9 < deadband
+            else:
+                unchanged = value == last[0]
+            if unchanged:
+                self.suppressed += 1
+                return False
+        self.last[topic] = (value, now)
+        self.passed += 1
+        return True
+
+    def forget(self, topic=None):
+        # Publish the topic (or everything) again on the next update
+        if topic is None:
+            self.last.clear()
+        else:
+            self.last.pop(topic, None)
+
+
+class Outbox:
+    # Bounded outbound buffer for broker outages.
+    #
+    # While connected, publish() goes straight to the MQTT client. While the
+    # broker is away messages are kept here instead of in paho's unbounded
+    # queue, coalesced by topic so only the latest value of each topic is
+    # kept, and the oldest topics are dropped once max_topics / max_bytes is
+    # reached. connected() flushes what is left, oldest update first.
+    # Memory stays the same however long the outage lasts.
+    def __init__(self, client, max_topics=500, max_bytes=256 * 1024):
+        self.client = client
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        self.pending = OrderedDict()  # topic -> (payload, qos, retain, size)
+        self.pending_bytes = 0
+        self.is_connected = False
+        self.lock = threading.Lock()
+        # Statistics
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushed = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            if self.is_connected and self.client.publish(topic, payload, qos=qos, retain=retain).rc == 0:
+                return True
+            self._store(topic, payload, qos, retain)
+            return False
+
+    def _store(self, topic, payload, qos, retain):
+        old = self.pending.pop(topic, None)
+        if old is not None:
+            self.pending_bytes -= old[3]
+            self.coalesced += 1
+        size = len(topic) + len(str(payload))
+        self.pending[topic] = (payload, qos, retain, size)
+        self.pending_bytes += size
+        while len(self.pending) > self.max_topics or self.pending_bytes > self.max_bytes:
+            _, dropped = self.pending.popitem(last=False)
+            self.pending_bytes -= dropped[3]
+            self.dropped += 1
+
+    def connected(self):
+        # Called from the client's on_connect, publishes what was kept while
+        # the broker was away. Returns the number of messages flushed.
+        flushed = 0
+        with self.lock:
+            self.is_connected = True
+            while self.pending:
+                topic, (payload, qos, retain, size) = self.pending.popitem(last=False)
+                self.pending_bytes -= size
+                if self.client.publish(topic, payload, qos=qos, retain=retain).rc != 0:
+                    # Lost the connection again, keep it for the next flush
+                    self.pending[topic] = (payload, qos, retain, size)
+                    self.pending.move_to_end(topic, last=False)
+                    self.pending_bytes += size
+                    self.is_connected = False
+                    break
+                flushed += 1
+            self.flushed += flushed
+        return flushed
+
+    def disconnected(self):
+        with self.lock:
+            self.is_connected = False
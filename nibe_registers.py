@@ -0,0 +1,262 @@
+import hashlib
+import html
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+
+logger = logging.getLogger('NIBE')
+
+# Register descriptor table for the logger frames.
+#
+# Built once at startup: a 256 entry list indexed by register number, so the
+# decode path in nibe.py is a single list index plus one precompiled function
+# call instead of a chain of "reg in [...]" scans.
+#
+#   number  register number on the bus
+#   topic   MQTT topic the decoded value is published to
+#   width   nominal width in bytes (the pump may still send small values as one byte)
+#   signed  raw value is a 16 bit two's complement number
+#   scale   raw value is divided by this (10 -> one decimal, 2 -> halves)
+#   decode  precompiled function taking the raw unsigned value, returns the
+#           value to publish or None when there is nothing to publish
+Register = namedtuple("Register", "number topic width signed scale decode")
+
+TABLE_SIZE = 256
+
+# Heating status texts for register 31
+heating_status_texts = {
+    1: "auto",
+    3: "lämmitys",        #heating
+    5: "lämminvesi",      #domestic water
+    6: "lisäys (sähkö)",  #additional heating
+}
+
+# number, topic, width, signed, scale, type of the published value
+register_definitions = [
+    (0, "nibe/cpu_id", 1, False, 1, int),
+    (1, "nibe/outdoor_temp_c", 2, True, 10, float),
+    (4, "nibe/heating_curve", 2, True, 10, int),
+    (5, "nibe/flow_setpoint_c", 2, True, 10, float),
+    (6, "nibe/flow_actual_c", 2, True, 10, float),
+    (7, "nibe/return_temp_c", 2, True, 10, float),
+    (8, "nibe/degree_minutes", 2, True, 10, int),
+    (9, "nibe/comp_freq_desired_hz", 2, False, 10, float),
+    (10, "nibe/comp_freq_actual_hz", 2, False, 10, float),
+    (11, "nibe/condenser_off_max", 2, True, 10, float),
+    (12, "nibe/domestic_hot_water_top_temp", 2, True, 10, float),
+    (13, "nibe/domestic_hot_water_bottom", 2, True, 10, float),
+    (14, "nibe/tho_r1_evap_temp", 2, True, 10, float),
+    (15, "nibe/tho_r2_evap_temp", 2, True, 10, float),
+    (16, "nibe/suction_gas_temp_tho_s", 2, True, 10, float),
+    (17, "nibe/hot_gas_temp_tho_d", 2, True, 10, float),
+    (18, "nibe/liquid_temp_ams", 2, True, 10, float),
+    (19, "nibe/high_pressure_bar", 2, False, 10, float),
+    (20, "nibe/low_pressure_bar", 2, False, 10, float),
+    (21, "nibe/resp_at_ams_tho_a", 2, True, 10, float),
+    (22, "nibe/ams_phase_is_a", 2, False, 10, float),
+    (23, "nibe/inverter_temp_tho_ip", 2, True, 10, float),
+    (24, "nibe/run_time_compressor_h", 2, False, 10, float),
+    (25, "nibe/compressor_starts", 2, False, 10, int),
+    (28, "nibe/operation_mode_reg_28", 2, False, 1, int),
+    (29, "nibe/operation_mode_reg_29", 2, False, 1, int),
+    (30, "nibe/operation_mode_reg_30", 2, False, 1, int),
+    (31, "nibe/heating_status", 1, False, 1, heating_status_texts.get),
+    (32, "nibe/additional_heating_allowed", 1, False, 1, str),
+    (33, "nibe/max_df_compressor", 2, False, 1, int),
+    (34, "nibe/verd_freq_reg_p", 1, False, 1, int),
+    (35, "nibe/min_start_time_freq_min", 1, False, 1, int),
+    (36, "nibe/min_time_const_freq_min", 1, False, 1, int),
+    (38, "nibe/comp_freq_grad_min", 1, False, 1, int),
+    (40, "nibe/hysteresis", 1, False, 2, float),
+    (43, "nibe/stop_temp_heating_c", 1, False, 1, float),
+    (44, "nibe/pump_speed_percent", 1, False, 1, int),
+    (45, "nibe/bw_reg_p", 1, False, 1, int),
+    (46, "nibe/bw_reg_q", 1, False, 1, int),
+    (47, "nibe/bw_reg_xp", 1, False, 2, float),
+    (48, "nibe/bw_reg_value_xp_percent", 1, False, 1, int),
+    (49, "nibe/domestic_hot_water_start_temp", 1, False, 1, float),
+    (50, "nibe/domestic_hot_water_stop_temp", 1, False, 1, float),
+    (100, "nibe/date_year", 1, False, 1, int),
+    (101, "nibe/date_month", 1, False, 1, int),
+    (102, "nibe/date_day", 1, False, 1, int),
+    (103, "nibe/time_hour", 1, False, 1, int),
+    (104, "nibe/time_minute", 1, False, 1, int),
+    (105, "nibe/time_second", 1, False, 1, int),
+]
+
+
+def raw_value(raw):
+    # Unsigned value of the one or two raw bytes of a register (big endian)
+    if len(raw) == 2:
+        return (raw[0] << 8) | raw[1]
+    return raw[0]
+
+
+def make_decoder(signed, scale, kind):
+    # Returns the cheapest function for the combination, divisions are kept as
+    # true divisions so the published values match the old decoder exactly.
+    if kind not in (int, float):
+        return kind
+    if signed:
+        if kind is int:
+            return lambda value: int((value - 0x10000 if value & 0x8000 else value) / scale)
+        return lambda value: (value - 0x10000 if value & 0x8000 else value) / scale
+    if scale == 1:
+        return kind
+    if kind is int:
+        return lambda value: int(value / scale)
+    return lambda value: value / scale
+
+
+def build_register_table(definitions=register_definitions):
+    table = [None] * TABLE_SIZE
+    for number, topic, width, signed, scale, kind in definitions:
+        table[number] = Register(number, topic, width, signed, scale, make_decoder(signed, scale, kind))
+    return table
+
+
+# Register map generated from register.txt / register.html.
+#
+# register_definitions above is written by hand for the registers the bridge
+# has always published. The register list of the logger (register.txt) and
+# the "Split" sheet of register.html describe more registers than that, so
+# the registers missing from register_definitions are generated from them:
+# name and unit from register.txt, width from the sample values of
+# register.html, scale from "(/N)" notes, the sample values or a decimal in
+# register.txt, signed for temperatures. Their topic is nibe/register_<n>.
+#
+# Parsing the 2 MB register.html takes a while, so the result is written to
+# a compact JSON cache and later startups only read the cache, unless the
+# size or modification time of a source file or register_definitions has
+# changed (a register added by hand is not generated any more).
+base_dir = os.path.dirname(os.path.abspath(__file__))
+register_sources = (os.path.join(base_dir, "register.txt"), os.path.join(base_dir, "register.html"))
+default_cache_file = os.path.join(base_dir, ".register_cache.json")
+cache_version = 1
+
+kinds = {"int": int, "float": float}
+
+
+def parse_register_txt(path):
+    # {register: (name, value text, unit)} from the nibe_monitor listing
+    registers = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            for number, name, value, unit in re.findall(r"(\d{3}) (.+?)\s*:\s*(-?[\d.]+) *(°C|Hz|bar|A|h|min|%)?", line):
+                registers[int(number)] = (name.strip(), value, unit or "")
+    return registers
+
+
+def parse_register_html(path):
+    # {register: (function, comment, [(raw hex, decoded text)])} from the
+    # "Split" sheet, which is the one for the split heat pumps
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    start = text.index('<A NAME="table0">')
+    end = text.find('<A NAME="table1">', start)
+    registers = {}
+    for row in re.findall(r"<tr>(.*?)</tr>", text[start:end], re.S):
+        cells = [html.unescape(re.sub(r"<[^>]+>", "", cell)).strip()
+                 for cell in re.findall(r"<td[^>]*>(.*?)</td>", row, re.S)]
+        if len(cells) < 10 or not cells[1].isdigit():
+            continue
+        samples = [(cells[i], cells[i + 1]) for i in (2, 4, 6) if cells[i]]
+        registers[int(cells[1])] = (cells[8], cells[9], samples)
+    return registers
+
+
+def _infer_scale(txt, html_row):
+    if html_row:
+        note = re.search(r"\(/(\d+)\)", f"{html_row[0]} {html_row[1]}")
+        if note:
+            return int(note.group(1))
+        for raw, decoded in html_row[2]:
+            try:
+                raw = int(raw.replace(" ", ""), 16)
+                decoded = float(decoded.replace(",", "."))
+            except ValueError:
+                continue
+            if decoded and raw != decoded and round(raw / decoded) == 10:
+                return 10
+    if txt and "." in txt[1]:
+        return 10
+    return 1
+
+
+def generate_register_map(txt_path=register_sources[0], html_path=register_sources[1]):
+    # List of register dicts (number, topic, width, signed, scale, kind, name,
+    # unit, generated) covering every register of the sources
+    txt = parse_register_txt(txt_path)
+    html_rows = parse_register_html(html_path)
+    known = {definition[0]: definition for definition in register_definitions}
+    register_map = []
+    for number in sorted(set(txt) | set(html_rows) | set(known)):
+        txt_row = txt.get(number)
+        html_row = html_rows.get(number)
+        name = txt_row[0] if txt_row and txt_row[0] != "?" else (html_row[0] if html_row and html_row[0] else "")
+        unit = txt_row[2] if txt_row else ""
+        if number in known:
+            _, topic, width, signed, scale, kind = known[number]
+            register_map.append({
+                "number": number, "topic": topic, "width": width, "signed": signed, "scale": scale,
+                "kind": kind.__name__ if kind in (int, float) else None, "name": name, "unit": unit, "generated": False,
+            })
+            continue
+        width = 2 if html_row and any(" " in raw or len(raw) > 2 for raw, _ in html_row[2]) else 1
+        scale = _infer_scale(txt_row, html_row)
+        register_map.append({
+            "number": number, "topic": f"nibe/register_{number}", "width": width, "signed": unit == "°C",
+            "scale": scale, "kind": "float" if scale != 1 else "int",
+            "name": name or f"Register {number}", "unit": unit, "generated": True,
+        })
+    return register_map
+
+
+def _source_stamps(sources):
+    stamps = []
+    for path in sources:
+        st = os.stat(path)
+        stamps.append([os.path.basename(path), st.st_mtime_ns, st.st_size])
+    return stamps
+
+
+def _definitions_digest():
+    # Stable across runs: the decoders are named, not compared
+    fields = [[number, topic, width, signed, scale, getattr(kind, "__qualname__", repr(kind))]
+              for number, topic, width, signed, scale, kind in register_definitions]
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def load_register_map(cache_file=default_cache_file, sources=register_sources):
+    # The generated register map, from the cache when it is up to date
+    stamps = _source_stamps(sources) + [["register_definitions", _definitions_digest()]]
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("version") == cache_version and cache.get("sources") == stamps:
+            return cache["registers"]
+    except (OSError, ValueError):
+        pass
+    register_map = generate_register_map(*sources)
+    try:
+        with open(cache_file, "w", encoding="utf-8") as f:
+            json.dump({"version": cache_version, "sources": stamps, "registers": register_map},
+                      f, ensure_ascii=False, separators=(",", ":"))
+    except OSError as e:
+        logger.warning(f"Could not write register cache {cache_file}: {e}")
+    return register_map
+
+
+def register_map_definitions(register_map):
+    # Definitions for build_register_table(): the hand written ones as they
+    # are (their decoders are not all plain numbers), the generated ones
+    # from the map. A generated entry never replaces a hand written one.
+    definitions = list(register_definitions)
+    defined = {definition[0] for definition in register_definitions}
+    for register in register_map:
+        if register["generated"] and register["number"] not in defined:
+            definitions.append((register["number"], register["topic"], register["width"], register["signed"],
+                                register["scale"], kinds[register["kind"]]))
+    return definitions
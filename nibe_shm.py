@@ -0,0 +1,221 @@
+import logging
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from nibe_framing import FrameParser, FrameStats
+from nibe_logging import forward_process_logs, setup_process_logging
+from nibe_metrics import Histogram, default_buckets
+
+logger = logging.getLogger('NIBE')
+
+# Two process runtime.
+#
+# A reader process per heat pump does nothing but the logger side of the
+# bus: it reads the serial port, frames, ACKs and checks the checksum, and
+# writes every valid frame into a ring buffer in shared memory. It is
+# started with "spawn", so it has its own GIL and no MQTT network thread,
+# log handler or decoding competes with it; the ACK timing stays the same
+# however busy the publishing side is. Its log records are sent to the main
+# process and written there (see nibe_logging.py).
+#
+# The main process polls the rings and decodes / publishes the frames.
+#
+# Ring layout (single writer, single reader):
+#
+#   header   write count, frames, crc errors, resyncs, bytes discarded (u64 each),
+#            ACK turnaround: sum, longest (f64 each), count per histogram bucket (u64 each)
+#   slots    sequence number (u64), timestamp (f64), length (u16), frame bytes
+#
+# The writer fills a slot and then bumps the write count. The reader checks
+# the sequence number of the slot before and after copying it, a slot that
+# was overwritten meanwhile (reader more than `slots` frames behind) is
+# counted as lost instead of being decoded half old, half new.
+ACK_BUCKETS = len(default_buckets) + 1
+HEADER = struct.Struct(f"<5Q2d{ACK_BUCKETS}Q")
+SLOT_HEADER = struct.Struct("<QdH")
+MAX_FRAME = 4 + 255 + 1  # header, length byte worth of data, checksum
+SLOT_SIZE = SLOT_HEADER.size + MAX_FRAME
+
+
+class FrameRing:
+    def __init__(self, name=None, slots=256, create=False):
+        self.slots = slots
+        size = HEADER.size + slots * SLOT_SIZE
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.shm.buf[:HEADER.size] = bytes(HEADER.size)
+        else:
+            # Spawned readers share the resource tracker of the main process
+            # (attaching registers the segment again, a no-op there), which
+            # removes the segment when the main process unlinks it or ends
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.read_count = 0
+        self.lost = 0
+        self.acks = ([0] * ACK_BUCKETS, 0.0)  # ACK bucket counts and sum copied so far
+
+    def _slot(self, seq):
+        return HEADER.size + (seq % self.slots) * SLOT_SIZE
+
+    # Writer side
+
+    # stats is the FrameStats of the parser, its ack_latency an AckLatency
+
+    def write(self, frame, stats):
+        seq = HEADER.unpack_from(self.buf, 0)[0]
+        offset = self._slot(seq)
+        length = len(frame)
+        SLOT_HEADER.pack_into(self.buf, offset, seq + 1, time.time(), length)
+        start = offset + SLOT_HEADER.size
+        self.buf[start:start + length] = frame
+        self._write_header(seq + 1, stats)
+
+    def write_stats(self, stats):
+        self._write_header(HEADER.unpack_from(self.buf, 0)[0], stats)
+
+    def _write_header(self, seq, stats):
+        acks = stats.ack_latency
+        HEADER.pack_into(self.buf, 0, seq, stats.frames, stats.crc_errors, stats.resyncs, stats.bytes_discarded,
+                         acks.sum, acks.max, *acks.counts)
+
+    # Reader side
+
+    def stats(self):
+        # (frames, crc errors, resyncs, bytes discarded) of the reader process
+        return HEADER.unpack_from(self.buf, 0)[1:5]
+
+    def read_acks(self):
+        # ACK turnarounds of the reader process since the last call: (bucket
+        # counts, sum, longest so far)
+        header = HEADER.unpack_from(self.buf, 0)
+        total, maximum, counts = header[5], header[6], header[7:]
+        copied_counts, copied_total = self.acks
+        if any(count < copied for count, copied in zip(counts, copied_counts)):
+            # The reader process was restarted and counts from 0 again
+            copied_counts, copied_total = [0] * ACK_BUCKETS, 0.0
+        self.acks = (list(counts), total)
+        return [count - copied for count, copied in zip(counts, copied_counts)], total - copied_total, maximum
+
+    def read(self):
+        # [(timestamp, frame bytes)] written since the last call
+        write_count = HEADER.unpack_from(self.buf, 0)[0]
+        if write_count - self.read_count > self.slots:
+            self.lost += write_count - self.read_count - self.slots
+            self.read_count = write_count - self.slots
+        frames = []
+        while self.read_count < write_count:
+            offset = self._slot(self.read_count)
+            seq, timestamp, length = SLOT_HEADER.unpack_from(self.buf, offset)
+            start = offset + SLOT_HEADER.size
+            frame = bytes(self.buf[start:start + length])
+            self.read_count += 1
+            if seq != self.read_count or SLOT_HEADER.unpack_from(self.buf, offset)[0] != seq:
+                self.lost += 1
+                continue
+            frames.append((timestamp, frame))
+        return frames
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class AckLatency(Histogram):
+    # ACK turnaround histogram of a reader process, also keeps the longest
+    def __init__(self):
+        super().__init__("ack", "", default_buckets)
+        self.max = 0.0
+
+    def observe(self, value):
+        super().observe(value)
+        if value > self.max:
+            self.max = value
+
+
+def reader_process(serial_port, ring_name, timeout=0.2, log_records=None, log_level=logging.WARNING):
+    # Main function of a reader process
+    if log_records is not None:
+        setup_process_logging(log_records, log_level)
+    import serial
+    ring = FrameRing(ring_name)
+    try:
+        ser = serial.Serial(serial_port, 19200, bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE,
+                            parity=serial.PARITY_NONE, timeout=timeout)
+    except Exception as e:
+        logger.warning("Reader process can not open %s: %s", serial_port, e)
+        ring.close()
+        return
+    parser = FrameParser(ser.write, lambda frame: ring.write(frame, parser.stats), FrameStats(ack_latency=AckLatency()))
+    try:
+        while True:
+            data = ser.read(ser.in_waiting or 1)
+            if data:
+                parser.feed(data)
+            else:
+                parser.idle()
+            ring.write_stats(parser.stats)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.warning("Error in reader process of %s: %s", serial_port, e)
+    finally:
+        ser.close()
+        ring.close()
+
+
+def run_reader_processes(serial_ports, handlers, stats, timeout=0.2, slots=256, poll_interval=0.01, log_level=logging.WARNING):
+    # Starts a reader process per serial port and hands their frames to the
+    # handler of the port, stats are FrameStats the reader counters are
+    # copied to (the ACK turnarounds are merged into their ack_latency, see
+    # BusTiming.merge). Runs until interrupted, a reader process that dies
+    # is started again.
+    context = multiprocessing.get_context("spawn")
+    log_records = context.Queue()
+    log_listener = forward_process_logs(log_records)
+    rings = [FrameRing(slots=slots, create=True) for _ in serial_ports]
+    processes = [None] * len(serial_ports)
+    restart_at = [0.0] * len(serial_ports)
+    try:
+        while True:
+            now = time.monotonic()
+            for i, port in enumerate(serial_ports):
+                process = processes[i]
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning(f"Reader process of {port} exited ({process.exitcode}), restarting")
+                    processes[i] = None
+                    restart_at[i] = now + 1
+                if now >= restart_at[i]:
+                    process = context.Process(target=reader_process, args=(port, rings[i].name, timeout, log_records, log_level),
+                                              name=f"nibe-reader-{i}", daemon=True)
+                    process.start()
+                    processes[i] = process
+                    logger.info(f"Reader process {process.pid} on {port}")
+
+            for ring, handler, frame_stats in zip(rings, handlers, stats):
+                for timestamp, frame in ring.read():
+                    try:
+                        handler(frame)
+                    except Exception as e:
+                        logger.warning("Error in Nibe data processing: %s", e)
+                (frame_stats.frames, frame_stats.crc_errors,
+                 frame_stats.resyncs, frame_stats.bytes_discarded) = ring.stats()
+                frame_stats.frames_dropped = ring.lost
+                counts, total, maximum = ring.read_acks()
+                if frame_stats.ack_latency is not None:
+                    frame_stats.ack_latency.merge(counts, total, maximum)
+            time.sleep(poll_interval)
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join(1)
+        for ring in rings:
+            ring.close(unlink=True)
+        log_listener.stop()
@@ -0,0 +1,124 @@
+import argparse
+import logging
+import os
+import select
+import time
+import tty
+
+from nibe_capture import read_capture
+from nibe_framing import ACK, PREAMBLE, build_frame
+
+logger = logging.getLogger('NIBE')
+
+# Simulated heat pump for running the bridge without RS-485 hardware.
+#
+# Opens a pty and plays the pump side of the logger handshake on it: send
+# the 03 00 14 preamble, wait for the ACK, send a frame, wait for the ACK.
+# Point serial_port in nibe.py to the printed device and start the bridge.
+#
+#   python nibe_simulator.py                    built in sample frame, 2 s apart
+#   python nibe_simulator.py capture.bin        frames from a capture, looped
+#   python nibe_simulator.py -i 0 capture.bin   as fast as the bridge ACKs
+
+# Raw values from register.txt: (register, raw value, width)
+sample_registers = [
+    (0, 89, 1), (1, 166, 2), (2, 32768, 2), (3, 32768, 2), (4, 0, 2), (5, 222, 2),
+    (6, 252, 2), (7, 237, 2), (8, 0, 2), (9, 0, 2), (10, 0, 2), (11, 261, 2),
+    (12, 503, 2), (13, 485, 2), (14, 140, 2), (15, 140, 2), (16, 228, 2), (17, 340, 2),
+    (18, 203, 2), (19, 129, 2), (20, 99, 2), (21, 158, 2), (22, 0, 2), (23, 270, 2),
+    (24, 57098, 2), (25, 900, 2), (26, 214, 2), (27, 252, 2), (28, 0, 2), (29, 33314, 2),
+    (30, 50, 2), (31, 1, 1), (32, 0, 1), (33, 768, 2), (34, 5, 1), (35, 70, 1),
+    (36, 3, 1), (37, 40, 1), (38, 126, 1), (39, 0, 1), (40, 2, 1), (41, 20, 1),
+    (42, 0, 1), (43, 17, 1), (44, 70, 1), (45, 14, 1), (46, 110, 1), (47, 5, 1),
+    (48, 40, 1), (49, 44, 1), (50, 50, 1), (100, 13, 1), (101, 10, 1), (102, 29, 1),
+    (103, 17, 1), (104, 30, 1), (105, 43, 1),
+]
+
+
+class HeatPumpSimulator:
+    def __init__(self, frames, interval=2.0, ack_timeout=0.5):
+        self.frames = frames
+        self.interval = interval
+        self.ack_timeout = ack_timeout
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        # Statistics
+        self.sent = 0
+        self.missed_acks = 0
+        self.ack_times = []
+
+    def _wait_ack(self):
+        start = time.monotonic()
+        deadline = start + self.ack_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([self.master], [], [], remaining)
+            if ready and ACK in os.read(self.master, 64):
+                return time.monotonic() - start
+
+    def _exchange(self, frame):
+        os.write(self.master, PREAMBLE)
+        if self._wait_ack() is None:
+            self.missed_acks += 1
+            logger.warning("No ACK for the preamble")
+            return
+        os.write(self.master, frame)
+        turnaround = self._wait_ack()
+        if turnaround is None:
+            self.missed_acks += 1
+            logger.warning("No ACK for the frame")
+            return
+        self.sent += 1
+        self.ack_times.append(turnaround)
+
+    def run(self, count=None):
+        next_frame = time.monotonic()
+        while count is None or self.sent + self.missed_acks < count:
+            for frame in self.frames:
+                if count is not None and self.sent + self.missed_acks >= count:
+                    break
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_frame = time.monotonic() + self.interval
+                self._exchange(frame)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Nibe heat pump logger on a pty")
+    parser.add_argument("capture", nargs="?", help="capture file to play back (default: built in sample frame)")
+    parser.add_argument("-i", "--interval", type=float, default=2.0, help="seconds between frames")
+    parser.add_argument("-n", "--count", type=int, help="stop after this many frames")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.capture:
+        frames = [frame for _, frame in read_capture(args.capture)]
+    else:
+        frames = [build_frame(sample_registers)]
+
+    simulator = HeatPumpSimulator(frames, interval=args.interval)
+    print(f"Simulated heat pump on {simulator.device}")
+    start = time.monotonic()
+    try:
+        simulator.run(args.count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        elapsed = time.monotonic() - start
+        print(f"{simulator.sent} frames in {elapsed:.1f} s, {simulator.missed_acks} missed ACKs")
+        if simulator.ack_times:
+            times = sorted(simulator.ack_times)
+            print(f"frame ACK turnaround: median {times[len(times) // 2] * 1000:.2f} ms, max {times[-1] * 1000:.2f} ms")
+        simulator.close()
+
+
+if __name__ == "__main__":
+    main()
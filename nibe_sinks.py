@@ -0,0 +1,181 @@
+import json
+import logging
+import queue
+import sys
+import threading
+
+logger = logging.getLogger('NIBE')
+
+# Output sinks and the fan-out to them.
+#
+# The frame handler decodes a frame and hands the values to
+# SinkDispatcher.dispatch(), which only puts them on the queue of every sink
+# and returns. Each sink has its own worker thread and bounded queue, so a
+# slow sink (broker away, slow disk) neither delays the serial loop and the
+# next ACK nor holds up the other sinks. A full queue drops per drop policy:
+#
+#   "oldest"  drop the oldest queued batch, keep the latest data (default)
+#   "newest"  drop the batch that does not fit
+#
+# A sink gets one batch per frame: write(source, timestamp, values), where
+# source is the heat pump the frame came from (its topic_prefix is the
+# device name), timestamp is time.time() of the frame and values is
+# [(register entry, value)] (see nibe_registers.Register, derived values
+# have no register number).
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+
+class Sink:
+    name = "sink"
+
+    def write(self, source, timestamp, values):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CallbackSink(Sink):
+    # Calls func(source, timestamp, values), e.g. the MQTT publishing of the
+    # heat pump
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def write(self, source, timestamp, values):
+        self.func(source, timestamp, values)
+
+
+def _escape_tag(text):
+    return text.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+class InfluxLineSink(Sink):
+    # InfluxDB line protocol, one line per value, appended to a file (for
+    # Telegraf's tail input or influx write --file):
+    #   nibe,device=nibe,register=1 outdoor_temp_c=16.6 1700000000000000000
+    name = "influx"
+
+    def __init__(self, path, measurement="nibe"):
+        self.path = path
+        self.measurement = _escape_tag(measurement)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, source, timestamp, values):
+        device = _escape_tag(source.topic_prefix)
+        ns = int(timestamp * 1e9)
+        lines = []
+        for entry, value in values:
+            field = _escape_tag(entry.topic.rsplit("/", 1)[-1])
+            if type(value) is str:
+                value = '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            elif type(value) is int:
+                value = f"{value}i"
+            tags = f"{self.measurement},device={device}"
+            if entry.number is not None:
+                tags += f",register={entry.number}"
+            lines.append(f"{tags} {field}={value} {ns}\n")
+        self.file.writelines(lines)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonStreamSink(Sink):
+    # One JSON document per frame and line, on stdout or appended to a file:
+    #   {"device": "nibe", "time": 1700000000.0, "values": {"outdoor_temp_c": 16.6, ...}}
+    name = "json"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8") if path else sys.stdout
+
+    def write(self, source, timestamp, values):
+        document = {
+            "device": source.topic_prefix,
+            "time": timestamp,
+            "values": {entry.topic.rsplit("/", 1)[-1]: value for entry, value in values},
+        }
+        self.file.write(json.dumps(document, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.path:
+            self.file.close()
+
+
+class SinkWorker:
+    # Queue and worker thread of one sink
+    def __init__(self, sink, queue_size=1000, drop=DROP_OLDEST):
+        self.sink = sink
+        self.queue = queue.Queue(queue_size)
+        self.drop = drop
+        self.thread = threading.Thread(target=self._run, name=f"nibe-sink-{sink.name}", daemon=True)
+        # Statistics
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def put(self, batch):
+        try:
+            self.queue.put_nowait(batch)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.drop == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.queue.put_nowait(batch)
+            except (queue.Empty, queue.Full):
+                pass
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"Sink {self.sink.name} falls behind, dropped {self.dropped} batches so far")
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                self.sink.write(*batch)
+                self.written += 1
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Error in sink %s: %s", self.sink.name, e)
+            finally:
+                self.queue.task_done()
+
+
+class SinkDispatcher:
+    def __init__(self):
+        self.workers = []
+
+    def add(self, sink, queue_size=1000, drop=DROP_OLDEST):
+        worker = SinkWorker(sink, queue_size, drop)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.thread.start()
+
+    def dispatch(self, source, timestamp, values):
+        batch = (source, timestamp, values)
+        for worker in self.workers:
+            worker.put(batch)
+
+    def close(self, timeout=5):
+        # Lets the workers write what is queued, then closes the sinks
+        for worker in self.workers:
+            try:
+                worker.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for worker in self.workers:
+            if worker.thread.is_alive():
+                worker.thread.join(timeout)
+            worker.sink.close()
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from array import array
+
+from nibe_registers import TABLE_SIZE
+
+logger = logging.getLogger('NIBE')
+
+# Latest state of every register, readable without MQTT.
+#
+# RegisterSnapshot is one table per heat pump, indexed by register number
+# like the register table: the raw value and the time of the last update in
+# flat arrays, the decoded value in a list. The decoder writes it in place
+# for every register of a frame (also the ones nibe.py does not handle), so
+# it is always current and never grows. Derived values are kept by name.
+#
+# The state of all heat pumps is served as one JSON document on a Unix
+# socket (connect, read until EOF) and on /state of the metrics HTTP server:
+#
+#   {"nibe": {"time": 1700000000.0, "frames": 1234,
+#             "registers": {"1": {"name": "outdoor_temp_c", "value": 16.6, "raw": 166, "updated": 1700000000.0}, ...},
+#             "derived": {"delta_t_c": {"value": 5.1, "updated": 1700000000.0}, ...}}}
+#
+# The document is only encoded again after a frame changed the table. A
+# request that comes in while a frame is being written may see that frame
+# half applied, every single register is consistent.
+#
+#   python3 nibe_snapshot.py nibe_state.sock
+
+
+class RegisterSnapshot:
+    def __init__(self, names=None):
+        self.names = list(names) if names else [None] * TABLE_SIZE  # register -> name in the document
+        self.values = [None] * TABLE_SIZE
+        self.raw = array("l", [0]) * TABLE_SIZE
+        self.updated = array("d", [0.0]) * TABLE_SIZE  # time.time(), 0 = never seen
+        self.derived = {}  # name -> (value, time.time())
+        self.frames = 0
+        self.time = 0.0
+
+    def update(self, reg, raw, value, now):
+        # The time last: document() skips registers that were never updated,
+        # so one seen for the first time is complete once it shows up
+        self.values[reg] = value
+        self.raw[reg] = raw
+        self.updated[reg] = now
+
+    def update_derived(self, name, value, now):
+        self.derived[name] = (value, now)
+
+    def frame(self, now):
+        # Called once the registers of a frame are written
+        self.frames += 1
+        self.time = now
+
+    def document(self):
+        registers = {}
+        names, values, raw, updated = self.names, self.values, self.raw, self.updated
+        for reg in range(TABLE_SIZE):
+            if updated[reg]:
+                registers[str(reg)] = {"name": names[reg], "value": values[reg], "raw": raw[reg], "updated": updated[reg]}
+        return {
+            "time": self.time,
+            "frames": self.frames,
+            "registers": registers,
+            "derived": {name: {"value": value, "updated": now} for name, (value, now) in self.derived.items()},
+        }
+
+
+class SnapshotDocument:
+    # JSON bytes of a {device: RegisterSnapshot} dict, encoded again only
+    # when a frame came in since the last request
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.lock = threading.Lock()
+        self.frames = None
+        self.encoded = b"{}"
+
+    def render(self):
+        with self.lock:
+            frames = tuple(snapshot.frames for snapshot in self.snapshots.values())
+            if frames != self.frames:
+                document = {device: snapshot.document() for device, snapshot in self.snapshots.items()}
+                self.encoded = json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                self.frames = frames
+            return self.encoded
+
+
+def start_snapshot_socket(path, render):
+    # Serves render() (bytes) to every connection on the Unix socket at path,
+    # on a daemon thread. Returns the server, or None where Unix sockets are
+    # not available or path is taken by something else.
+    if not hasattr(socket, "AF_UNIX"):
+        logger.warning("Unix sockets are not available, not serving the state snapshot")
+        return None
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.sendall(render())
+
+    # A socket left behind by an earlier run would make bind() fail. Anything
+    # else at path is not ours to remove (a mistyped --state-socket).
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            logger.warning(f"{path} exists and is not a socket, not serving the state snapshot")
+            return None
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="nibe-snapshot", daemon=True).start()
+    logger.info(f"State snapshot on unix socket {path}")
+    return server
+
+
+def read_snapshot(path, timeout=2):
+    # Client side: the whole document from the socket at path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+if __name__ == "__main__":
+    print(json.dumps(read_snapshot(sys.argv[1] if len(sys.argv) > 1 else "nibe_state.sock"), indent=2, ensure_ascii=False))
@@ -0,0 +1,145 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('NIBE')
+
+# Local history of the register values in SQLite.
+#
+# record() only appends the rows of a frame to a list in memory; a writer
+# thread inserts them with one executemany() per batch, when batch_size rows
+# are waiting or every flush_interval seconds, so the serial loop never
+# waits for the disk. The database is in WAL mode, readers (e.g. sqlite3 on
+# the command line or Grafana) do not block the writer.
+#
+# Once an hour the writer downsamples the raw samples older than
+# downsample_after seconds into samples_downsampled (mean / min / max per
+# downsample_interval bucket) and deletes everything older than retention
+# seconds. 0 turns either off.
+#
+# With an idle scheduler (nibe_timing.py) the writer waits for the quiet gap
+# between two frames before it commits, expecting the commit to take as long
+# as the last one did.
+schema = """
+CREATE TABLE IF NOT EXISTS samples (
+    device TEXT NOT NULL,
+    register INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_register_ts ON samples (device, register, ts);
+CREATE TABLE IF NOT EXISTS samples_downsampled (
+    device TEXT NOT NULL,
+    register INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    mean REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_downsampled_register_ts ON samples_downsampled (device, register, ts);
+"""
+
+MAINTENANCE_INTERVAL = 3600
+
+
+class SQLiteSink:
+    def __init__(self, path, batch_size=500, flush_interval=10, max_pending=100000,
+                 retention=365 * 86400, downsample_after=7 * 86400, downsample_interval=300, idle=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retention = retention
+        self.downsample_after = downsample_after
+        self.downsample_interval = downsample_interval
+        self.idle = idle
+        self.commit_seconds = 0.01
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.next_maintenance = 0
+        # Statistics
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="nibe-sqlite", daemon=True)
+        self.thread.start()
+
+    def record(self, device, timestamp, values):
+        # values is [(register, value)] of one frame, text values are skipped
+        rows = [(device, reg, timestamp, value) for reg, value in values if type(value) is not str]
+        with self.lock:
+            self.pending.extend(rows)
+            if len(self.pending) > self.max_pending:
+                # The disk does not keep up, drop the oldest rows
+                excess = len(self.pending) - self.max_pending
+                del self.pending[:excess]
+                self.dropped += excess
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def close(self):
+        # Writes what is still pending and stops the writer
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(schema)
+            while True:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                try:
+                    if self.idle is not None and self.pending and not self.stopping:
+                        self.idle.wait(self.commit_seconds)
+                    self._flush(db)
+                    if time.time() >= self.next_maintenance:
+                        self._maintain(db)
+                        self.next_maintenance = time.time() + MAINTENANCE_INTERVAL
+                except sqlite3.Error as e:
+                    logger.warning(f"SQLite history {self.path}: {e}")
+                if self.stopping:
+                    break
+        finally:
+            db.close()
+
+    def _flush(self, db):
+        with self.lock:
+            rows = self.pending
+            self.pending = []
+        if rows:
+            start = time.perf_counter()
+            with db:
+                db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", rows)
+            self.commit_seconds = time.perf_counter() - start
+            self.written += len(rows)
+
+    def _maintain(self, db):
+        now = time.time()
+        with db:
+            if self.downsample_after:
+                # Whole buckets only, a bucket is never downsampled twice
+                interval = self.downsample_interval
+                cutoff = (now - self.downsample_after) // interval * interval
+                db.execute(
+                    "INSERT INTO samples_downsampled "
+                    "SELECT device, register, CAST(ts / ? AS INTEGER) * ?, avg(value), min(value), max(value), count(*) "
+                    "FROM samples WHERE ts < ? GROUP BY device, register, CAST(ts / ? AS INTEGER)",
+                    (interval, interval, cutoff, interval),
+                )
+                db.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+            if self.retention:
+                cutoff = now - self.retention
+                db.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+                db.execute("DELETE FROM samples_downsampled WHERE ts < ?", (cutoff,))
@@ -0,0 +1,165 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('NIBE')
+
+# Timing of the logger bus and scheduling of background work around it.
+#
+# The heat pump decides when a frame comes, the bridge only has to answer
+# it. BusTiming keeps the intervals of the last `window` frames of one heat
+# pump: their median is the frame interval, the median deviation from it the
+# jitter, and the next frame is expected one interval after the last one (a
+# missed frame only shifts the prediction by whole intervals). It also keeps
+# the ACK turnaround, it stands in for the ack_latency histogram of
+# FrameStats and passes the times on to it.
+#
+# IdleScheduler uses the predictions of all heat pumps to run work that can
+# wait (discovery republishing, aggregation flushes, SQLite commits) in the
+# quiet gap after a frame instead of at a random time, where it could hold
+# the GIL while the next preamble has to be ACKed. Work that finds no gap
+# long enough runs anyway after max_delay seconds, so a bus that is too busy
+# or silent never holds it back for long.
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class BusTiming:
+    def __init__(self, window=64, ack_latency=None):
+        self.intervals = deque(maxlen=window)
+        self.ack_latency = ack_latency  # histogram the ACK times are passed on to
+        self.last = None  # time.monotonic() of the last frame
+        self.interval = None  # median frame interval, None until 3 intervals are known
+        self.jitter = 0.0
+        self.frames = 0
+        self.ack_last = 0.0
+        self.ack_max = 0.0
+
+    def observe(self, seconds):
+        # ACK turnaround, called by the parser (FrameStats.ack_latency)
+        self.ack_last = seconds
+        if seconds > self.ack_max:
+            self.ack_max = seconds
+        if self.ack_latency is not None:
+            self.ack_latency.observe(seconds)
+
+    def merge(self, counts, total, maximum):
+        # ACK turnarounds measured in a reader process (nibe_shm.py): bucket
+        # counts and sum since the last merge, longest one so far
+        if maximum > self.ack_max:
+            self.ack_max = maximum
+        if self.ack_latency is not None:
+            self.ack_latency.merge(counts, total)
+
+    def frame(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+            if len(self.intervals) >= 3:
+                self.interval = _median(self.intervals)
+                self.jitter = _median([abs(d - self.interval) for d in self.intervals])
+        self.last = now
+        self.frames += 1
+
+    def next_frame(self, now=None):
+        # Expected time.monotonic() of the next frame, None while unknown
+        if self.interval is None or self.interval <= 0:
+            return None
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.last
+        return now + self.interval - elapsed % self.interval
+
+
+class IdleScheduler:
+    def __init__(self, timings, guard=0.05, max_delay=5.0):
+        self.timings = list(timings)
+        self.guard = guard  # kept free before the next frame, plus 3 x jitter
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.jobs = deque()
+        self.thread = None
+        self.stopping = False
+        # Statistics
+        self.in_gap = 0
+        self.forced = 0
+
+    def quiet_for(self, now=None):
+        # Seconds of quiet left before the next frame expected on any bus,
+        # inf while no bus has a prediction yet
+        if now is None:
+            now = time.monotonic()
+        quiet = math.inf
+        for timing in self.timings:
+            next_frame = timing.next_frame(now)
+            if next_frame is not None:
+                quiet = min(quiet, next_frame - now - self.guard - 3 * timing.jitter)
+        return quiet
+
+    def idle(self, duration):
+        # True when work of about duration seconds fits before the next frame
+        return self.quiet_for() >= duration
+
+    def frame(self):
+        # Called after every frame, a new gap starts
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, duration, max_delay=None):
+        # Blocks until work of about duration seconds fits before the next
+        # frame, at most max_delay seconds. Returns False when it gave up.
+        deadline = time.monotonic() + (self.max_delay if max_delay is None else max_delay)
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                quiet = self.quiet_for(now)
+                if quiet >= duration:
+                    self.in_gap += 1
+                    return True
+                if now >= deadline or self.stopping:
+                    self.forced += 1
+                    return False
+                # Sleep until the next frame has been handled (or should
+                # have been, when it is missed)
+                self.condition.wait(min(deadline - now, max(quiet + 2 * self.guard, 0.01)))
+
+    # Jobs, run one by one on the scheduler thread
+
+    def submit(self, func, duration=0.05):
+        with self.condition:
+            self.jobs.append((func, duration))
+            self.condition.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="nibe-idle", daemon=True)
+        self.thread.start()
+
+    def close(self, timeout=5):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.stopping:
+                    self.condition.wait()
+                if not self.jobs:
+                    return
+                func, duration = self.jobs.popleft()
+            self.wait(duration)
+            try:
+                func()
+            except Exception as e:
+                logger.warning("Error in background job %s: %s", getattr(func, "__name__", func), e)
@@ -0,0 +1,64 @@
+from nibe_derived import COMPRESSOR_FREQ, COMPRESSOR_STARTS, FLOW, OPERATION_MODE, RETURN, DerivedMetrics
+
+
+def values(result):
+    return dict(result)
+
+
+def test_delta_t_once_per_frame():
+    derived = DerivedMetrics()
+    assert derived.update(FLOW, 35.2, 0) == []
+    assert derived.update(RETURN, 30.1, 0) == []
+    assert derived.end_frame() == [("delta_t_c", 5.1)]
+    # Nothing new in the next frame
+    assert derived.end_frame() == []
+
+
+def test_duty_cycle():
+    # 10 minutes on, 20 minutes off, one sample a minute for three hours
+    derived = DerivedMetrics(window=3600)
+    duty = {}
+    cycles = {}
+    for minute in range(181):
+        now = minute * 60
+        result = values(derived.update(COMPRESSOR_FREQ, 50 if minute % 30 < 10 else 0, now))
+        duty[minute] = result.get("compressor_duty_percent")
+        for name in ("compressor_on_minutes", "compressor_off_minutes"):
+            if name in result:
+                cycles.setdefault(name, set()).add(result[name])
+    # Nothing to go by on the first sample, before the window is full the
+    # share of the time seen so far
+    assert duty[0] is None
+    assert duty[5] == 100.0
+    assert duty[20] == 50.0
+    # Once it is full the oldest on period is clipped at the window start
+    assert {duty[minute] for minute in range(60, 181)} == {33.3}
+    assert cycles == {"compressor_on_minutes": {10.0}, "compressor_off_minutes": {20.0}}
+
+
+def test_starts_per_hour():
+    derived = DerivedMetrics(window=3600)
+    assert derived.update(COMPRESSOR_STARTS, 100, 0) == []
+    # Less than a tenth of the window is too short for a rate
+    assert derived.update(COMPRESSOR_STARTS, 100, 300) == []
+    assert derived.update(COMPRESSOR_STARTS, 101, 600) == [("compressor_starts_per_hour", 6.0)]
+    # The counter was reset: start over instead of a negative rate
+    assert derived.update(COMPRESSOR_STARTS, 5, 1200) == []
+    assert derived.update(COMPRESSOR_STARTS, 5, 1500) == []
+    assert derived.update(COMPRESSOR_STARTS, 6, 1800) == [("compressor_starts_per_hour", 6.0)]
+    # Samples older than the window are dropped
+    assert derived.update(COMPRESSOR_STARTS, 8, 10000) == [("compressor_starts_per_hour", 2.0)]
+
+
+def test_defrosts():
+    derived = DerivedMetrics(defrost_window=86400)
+    assert derived.update(OPERATION_MODE, "Lämmitys", 0) == [("defrosts_per_day", 0)]
+    assert derived.update(OPERATION_MODE, "Sulatus", 100) == [("defrosts_per_day", 1)]
+    # Still the same defrost
+    assert derived.update(OPERATION_MODE, "Sulatus", 200) == [("defrosts_per_day", 1)]
+    assert derived.update(OPERATION_MODE, "Lämmitys", 300) == [("defrosts_per_day", 1)]
+    assert values(derived.update(OPERATION_MODE, "Sulatus", 3900)) == {
+        "defrost_interval_minutes": 63.3, "defrosts_per_day": 2,
+    }
+    # The first one leaves the window a day later
+    assert derived.update(OPERATION_MODE, "Lämmitys", 100 + 86400) == [("defrosts_per_day", 1)]
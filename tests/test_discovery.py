@@ -0,0 +1,91 @@
+import itertools
+import threading
+from collections import namedtuple
+
+from nibe_discovery import DiscoveryPublisher
+
+Message = namedtuple("Message", "topic payload retain")
+Info = namedtuple("Info", "rc")
+
+CONFIGS = [(f"homeassistant/sensor/nibe_{n}/config", f'{{"n":{n}}}'.encode()) for n in range(20)]
+
+
+class FakeClient:
+    # Keeps retained messages like a broker, SUBACK and the retained copies
+    # arrive a little later on another thread like paho's network thread
+    def __init__(self):
+        self.retained = {}
+        self.callbacks = {}
+        self.on_subscribe = None
+        self.mids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        return Info(0)
+
+    def subscribe(self, topics):
+        mid = next(self.mids)
+        threading.Timer(0.05, self._answer, args=(mid, [topic for topic, _ in topics])).start()
+        return 0, mid
+
+    def _answer(self, mid, topics):
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, None, mid, (0,) * len(topics))
+        for topic in topics:
+            with self.lock:
+                payload = self.retained.get(topic)
+            callback = self.callbacks.get(topic)
+            if payload is not None and callback is not None:
+                callback(self, None, Message(topic, payload, True))
+
+    def unsubscribe(self, topics):
+        return 0, next(self.mids)
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def message_callback_remove(self, topic):
+        self.callbacks.pop(topic, None)
+
+
+def announce(discovery, results):
+    results.append(discovery.check_broker([topic for topic, _ in CONFIGS], timeout=1, settle=0.1))
+    discovery.publish(CONFIGS)
+
+
+def test_unchanged_configs_are_not_published_again():
+    client = FakeClient()
+    discovery = DiscoveryPublisher(client, None)
+    assert discovery.publish(CONFIGS) == len(CONFIGS)
+    assert discovery.publish(CONFIGS) == 0
+    assert discovery.publish(CONFIGS[1:]) == 1
+    assert CONFIGS[0][0] not in client.retained
+
+
+def test_check_broker_republishes_lost_configs():
+    client = FakeClient()
+    discovery = DiscoveryPublisher(client, None)
+    discovery.publish(CONFIGS)
+    del client.retained[CONFIGS[3][0]]
+    assert discovery.check_broker([topic for topic, _ in CONFIGS], timeout=1, settle=0.1)
+    assert discovery.publish(CONFIGS) == 1
+    assert client.retained == dict(CONFIGS)
+
+
+def test_concurrent_announces():
+    # Two reconnects in a row, both announce while the first still waits
+    client = FakeClient()
+    discovery = DiscoveryPublisher(client, None)
+    results = []
+    threads = [threading.Thread(target=announce, args=(discovery, results)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True, True]
+    assert client.retained == dict(CONFIGS)
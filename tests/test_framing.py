@@ -0,0 +1,89 @@
+from nibe_framing import ACK, PREAMBLE, FrameParser, build_frame, frame_payload, iter_registers
+
+REGISTERS = [(1, 166, 2), (2, 251, 2), (13, 0, 1), (25, 480, 2)]
+
+
+def make_parser():
+    acks = []
+    frames = []
+    parser = FrameParser(acks.append, lambda frame: frames.append(bytes(frame)))
+    return parser, acks, frames
+
+
+def test_frame():
+    parser, acks, frames = make_parser()
+    frame = build_frame(REGISTERS)
+    parser.feed(PREAMBLE + frame)
+    assert frames == [frame]
+    assert acks == [ACK, ACK]
+    assert list(iter_registers(frame_payload(frames[0]))) == [(reg, value) for reg, value, _ in REGISTERS]
+
+
+def test_frame_split_across_reads():
+    parser, acks, frames = make_parser()
+    data = PREAMBLE + build_frame(REGISTERS)
+    parser.feed(data[:9])
+    assert frames == []
+    assert acks == [ACK]  # the preamble is ACKed at once
+    parser.feed(data[9:])
+    assert frames == [data[len(PREAMBLE):]]
+    assert acks == [ACK, ACK]
+
+
+def test_bad_checksum():
+    parser, acks, frames = make_parser()
+    frame = build_frame(REGISTERS)
+    broken = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+    parser.feed(PREAMBLE + broken + PREAMBLE + frame)
+    assert frames == [frame]
+    assert parser.stats.crc_errors == 1
+    assert parser.stats.frames == 1
+
+
+def test_resync_after_garbage():
+    parser, acks, frames = make_parser()
+    frame = build_frame(REGISTERS)
+    parser.feed(b"\x55\xaa\x00\x03" + PREAMBLE + frame)
+    assert frames == [frame]
+    assert parser.stats.bytes_discarded == 4
+
+
+def test_resync_after_stalled_frame():
+    parser, acks, frames = make_parser()
+    frame = build_frame(REGISTERS)
+    # Header and length came, the rest of the frame never does
+    parser.feed(PREAMBLE + frame[:6])
+    parser.idle()
+    assert parser.stats.resyncs == 1
+    parser.feed(PREAMBLE + frame)
+    assert frames == [frame]
+
+
+def test_reset_drops_partial_frame():
+    parser, acks, frames = make_parser()
+    frame = build_frame(REGISTERS)
+    parser.feed(PREAMBLE + frame[:6])
+    parser.reset()
+    parser.feed(PREAMBLE + frame)
+    assert frames == [frame]
+    assert parser.stats.resyncs == 0
+
+
+def test_handler_error():
+    acks = []
+    walked = []
+
+    def on_frame(frame):
+        registers = iter_registers(frame_payload(frame))
+        walked.append(next(registers))
+        raise ValueError("broken handler")
+
+    parser = FrameParser(acks.append, on_frame)
+    frame = build_frame(REGISTERS)
+    parser.feed(PREAMBLE + frame)
+    parser.feed(PREAMBLE + frame)
+    assert walked == [(1, 166), (1, 166)]
+    assert acks == [ACK] * 4
+    assert parser.stats.handler_errors == 2
+    assert parser.stats.frames == 2
+    assert len(parser.buffer) == 0
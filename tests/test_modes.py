@@ -0,0 +1,55 @@
+import pytest
+
+from nibe_modes import OperationModeDecoder
+
+# The combinations of the elif chain operation_modes.json replaced, with the
+# numbers as they were written there
+OLD_MODES = [
+    ((0x0000, 0x8222, 0x0032), "Pois päältä"),
+    ((0x4409, 0xA22A, 0x01FE), "Käyttövesi"),
+    ((0x0008, 0xC22A, 0x000A), "Pois päältä"),
+    ((26634, 49706, 170), "Öljy paluu"),
+    ((16394, 49706, 610), "Lämmitys"),
+    ((16394, 49706, 10), "Lämmitys"),
+    ((16650, 49706, 610), "Lämmitys"),
+    ((0x0000, 0xC22A, 0x003C), "Vain sähkövastukset"),
+    ((16385, 41514, 50), "Käyttövesi"),
+    ((16393, 49706, 10), "Lämmitys"),
+    ((10, 49706, 10), "Pois päältä"),
+    ((28, 49706, 10), "lämmitys"),
+    ((10, 49706, 610), "Pois päältä"),
+    ((32776, 49706, 10), "Jäätymisensuoja"),
+    ((32778, 49706, 10), "Jäätymisensuoja"),
+    ((17419, 41514, 510), "Käyttövesi"),
+    ((17425, 41514, 450), "LisäLV"),
+    ((24586, 49706, 270), "Sulatus"),
+    ((24842, 49706, 270), "Sulatus"),
+    ((17409, 41514, 30), "Käyttövesi"),
+]
+
+
+@pytest.fixture
+def decoder():
+    return OperationModeDecoder.from_file()
+
+
+def decode(decoder, reg28, reg29, reg30):
+    assert decoder.decode_reg28(reg28) is None
+    assert decoder.decode_reg29(reg29) is None
+    return decoder.decode_reg30(reg30)
+
+
+def test_known_combinations(decoder):
+    assert len(decoder.modes) == len(OLD_MODES)
+    for registers, mode in OLD_MODES:
+        assert decode(decoder, *registers) == mode, registers
+
+
+def test_bits_rule(decoder):
+    # Compressor on (0x4000) in a combination the table does not list
+    assert decode(decoder, 0x4003, 0xC22A, 0x0100) == "Lämmitys"
+    assert decoder.mode == "Lämmitys"
+
+
+def test_unknown_combination(decoder):
+    assert decode(decoder, 0x0001, 0xC22A, 0x000A) == "Unknown mode: reg28=1, reg29=49706, reg30=10"
@@ -0,0 +1,120 @@
+from collections import namedtuple
+
+from nibe_publish import ChangeFilter, Outbox
+
+Info = namedtuple("Info", "rc")
+
+
+class FakeClient:
+    # Records what was published, publish fails once `fail_after` messages
+    # went out (the connection dropped)
+    def __init__(self, fail_after=None):
+        self.published = []
+        self.fail_after = fail_after
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if self.fail_after is not None and len(self.published) >= self.fail_after:
+            return Info(4)
+        self.published.append((topic, payload, qos, retain))
+        return Info(0)
+
+
+def test_connected_publishes_directly():
+    client = FakeClient()
+    outbox = Outbox(client)
+    outbox.connected()
+    assert outbox.publish("nibe/a", "1", qos=1, retain=True)
+    assert client.published == [("nibe/a", "1", 1, True)]
+    assert not outbox.pending
+
+
+def test_coalesced_by_topic():
+    client = FakeClient()
+    outbox = Outbox(client)
+    assert not outbox.publish("nibe/a", "1")
+    outbox.publish("nibe/b", "2")
+    outbox.publish("nibe/a", "3")
+    assert outbox.coalesced == 1
+    assert len(outbox.pending) == 2
+    assert outbox.pending_bytes == len("nibe/b2") + len("nibe/a3")
+    # Oldest update first: b was last changed before a
+    assert outbox.connected() == 2
+    assert client.published == [("nibe/b", "2", 0, False), ("nibe/a", "3", 0, False)]
+    assert outbox.pending_bytes == 0
+
+
+def test_max_topics_drops_oldest():
+    outbox = Outbox(FakeClient(), max_topics=2)
+    for topic in ("nibe/a", "nibe/b", "nibe/c"):
+        outbox.publish(topic, "1")
+    assert list(outbox.pending) == ["nibe/b", "nibe/c"]
+    assert outbox.dropped == 1
+
+
+def test_max_bytes_drops_oldest():
+    outbox = Outbox(FakeClient(), max_bytes=20)
+    outbox.publish("nibe/a", "12345")  # 11 bytes
+    outbox.publish("nibe/b", "12345")
+    assert list(outbox.pending) == ["nibe/b"]
+    assert outbox.pending_bytes == 11
+    assert outbox.dropped == 1
+
+
+def test_failed_flush_keeps_message_first():
+    client = FakeClient(fail_after=1)
+    outbox = Outbox(client)
+    for topic in ("nibe/a", "nibe/b", "nibe/c"):
+        outbox.publish(topic, "1")
+    assert outbox.connected() == 1
+    assert not outbox.is_connected
+    assert list(outbox.pending) == ["nibe/b", "nibe/c"]
+    assert outbox.pending_bytes == 2 * len("nibe/b1")
+    client.fail_after = None
+    assert outbox.connected() == 2
+    assert [message[0] for message in client.published] == ["nibe/a", "nibe/b", "nibe/c"]
+
+
+def test_disconnected_buffers_again():
+    client = FakeClient()
+    outbox = Outbox(client)
+    outbox.connected()
+    outbox.disconnected()
+    assert not outbox.publish("nibe/a", "1")
+    assert client.published == []
+
+
+def test_change_filter_deadband():
+    change_filter = ChangeFilter({"nibe/temp": 0.2}, heartbeat=300)
+    assert change_filter.changed("nibe/temp", 21.3, now=0)
+    assert not change_filter.changed("nibe/temp", 21.4, now=1)
+    # Measured from the last published value, not the last seen one
+    assert change_filter.changed("nibe/temp", 21.5, now=2)
+    assert not change_filter.changed("nibe/temp", 21.4, now=3)
+    assert change_filter.passed == 2
+    assert change_filter.suppressed == 2
+
+
+def test_change_filter_without_deadband():
+    change_filter = ChangeFilter(heartbeat=300)
+    assert change_filter.changed("nibe/mode", "Lämmitys", now=0)
+    assert not change_filter.changed("nibe/mode", "Lämmitys", now=1)
+    assert change_filter.changed("nibe/mode", "Sulatus", now=2)
+
+
+def test_change_filter_heartbeat():
+    change_filter = ChangeFilter({"nibe/temp": 0.2}, heartbeat=300)
+    assert change_filter.changed("nibe/temp", 21.3, now=0)
+    assert not change_filter.changed("nibe/temp", 21.3, now=299)
+    assert change_filter.changed("nibe/temp", 21.3, now=300)
+    assert not change_filter.changed("nibe/temp", 21.3, now=301)
+
+
+def test_change_filter_forget():
+    change_filter = ChangeFilter()
+    change_filter.changed("nibe/a", 1, now=0)
+    change_filter.changed("nibe/b", 1, now=0)
+    change_filter.forget("nibe/a")
+    assert change_filter.changed("nibe/a", 1, now=1)
+    assert not change_filter.changed("nibe/b", 1, now=1)
+    change_filter.forget()
+    assert change_filter.changed("nibe/b", 1, now=1)
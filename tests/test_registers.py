@@ -0,0 +1,31 @@
+import nibe_registers
+from nibe_registers import build_register_table, load_register_map, register_map_definitions
+
+REGISTER_26 = (26, "nibe/test_register_26", 2, False, 1, int)
+
+
+def test_generated_registers_cached(tmp_path):
+    cache_file = tmp_path / "register_cache.json"
+    register_map = load_register_map(cache_file)
+    assert cache_file.exists()
+    assert load_register_map(cache_file) == register_map
+    generated = {register["number"]: register for register in register_map if register["generated"]}
+    assert generated[26]["topic"] == "nibe/register_26"
+    assert 1 not in generated
+
+
+def test_register_added_by_hand(tmp_path, monkeypatch):
+    cache_file = tmp_path / "register_cache.json"
+    stale_map = load_register_map(cache_file)
+    monkeypatch.setattr(nibe_registers, "register_definitions", nibe_registers.register_definitions + [REGISTER_26])
+    # The cache of the old definitions is not used any more
+    register_map = load_register_map(cache_file)
+    assert [register for register in register_map if register["number"] == 26] == [{
+        "number": 26, "topic": "nibe/test_register_26", "width": 2, "signed": False, "scale": 1,
+        "kind": "int", "name": "", "unit": "", "generated": False,
+    }]
+    # Nor does a stale generated entry replace the hand written one
+    for current in (register_map, stale_map):
+        table = build_register_table(register_map_definitions(current))
+        assert table[26].topic == "nibe/test_register_26"
+        assert [definition[0] for definition in register_map_definitions(current)].count(26) == 1
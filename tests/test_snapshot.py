@@ -0,0 +1,23 @@
+import socket
+
+from nibe_snapshot import read_snapshot, start_snapshot_socket
+
+
+def test_regular_file_is_kept(tmp_path):
+    path = tmp_path / "nibe.py"
+    path.write_text("keep me")
+    assert start_snapshot_socket(str(path), lambda: b"{}") is None
+    assert path.read_text() == "keep me"
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / "nibe_state.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    server = start_snapshot_socket(path, lambda: b'{"nibe": {}}')
+    try:
+        assert read_snapshot(path) == {"nibe": {}}
+    finally:
+        server.shutdown()
+        server.server_close()